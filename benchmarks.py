@@ -0,0 +1,454 @@
+# benchmarks.py
+# Micro-benchmarks for the server hot paths. Run with: python benchmarks.py
+
+import time, random, socket, tracemalloc, gc, secrets
+from collections import OrderedDict
+import server, protocol, reliable, player, combat, spatial
+
+
+def make_fake_players(num_players):
+    """
+    Builds a players dict shaped like server_db.json with num_players accounts.
+    """
+    return {
+        str(i): {
+            "username": f"user{i}",
+            "password": f"{i:064x}",
+            "logins": 0
+        }
+        for i in range(1, num_players + 1)
+    }
+
+
+def linear_check_db(players, username, password):
+    # The original check_db implementation, kept here as the baseline
+    for pid, pdata in players.items():
+        if pdata["username"] == username and pdata["password"] == password:
+            return pid
+    return None
+
+
+def time_lookups(lookup, usernames, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for username, password in usernames:
+            lookup(username, password)
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeats * len(usernames)) * 1e6  # microseconds per lookup
+
+
+def bench_username_lookup(sizes=(1_000, 10_000, 100_000, 300_000)):
+    """
+    Compares the linear scan against the username index as the account count grows.
+    """
+    pServer = server.Server(port=0)
+    pServer.sl.debug_mode = False
+    print("accounts | linear scan (us) | indexed (us)")
+
+    for size in sizes:
+        pServer.storage.players = make_fake_players(size)
+        pServer.storage.rebuild_username_index()
+
+        # Worst case for the scan: the last account in the dict
+        targets = [(f"user{size}", f"{size:064x}"), (f"user{size // 2}", f"{size // 2:064x}")]
+
+        linear = time_lookups(lambda u, p: linear_check_db(pServer.storage.players, u, p), targets, 3)
+        indexed = time_lookups(pServer.check_db, targets, 10_000)
+        print(f"{size:>8} | {linear:>16.2f} | {indexed:>12.3f}")
+
+    pServer.close()
+
+
+def linear_check_for_timeouts(active_players, timeout, now):
+    # The original check_for_timeouts scan, kept here as the baseline
+    return [address for address, data in active_players.items() if now - data.last_ping > timeout]
+
+
+def bench_client_timeouts(num_clients=50_000, stale_fraction=0.01, rounds=100):
+    """
+    Compares scanning every active client against the expiry heap, both for a
+    check where nobody is due and for one that expires the stale clients.
+    """
+    pServer = server.Server(port=0)
+    pServer.sl.debug_mode = False
+    now = time.monotonic()
+
+    for i in range(num_clients):
+        address = ("10.0.0.1", i)
+        pServer.start_session(address, str(i), player.Player())
+        pServer.active_players[address].last_ping = now - random.uniform(0, pServer.client_timeout - 5)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        linear_check_for_timeouts(pServer.active_players, pServer.client_timeout, time.monotonic())
+    linear_idle = (time.perf_counter() - start) / rounds * 1e3
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        pServer.check_for_timeouts()
+    heap_idle = (time.perf_counter() - start) / rounds * 1e3
+
+    # Let some clients go quiet and move their heap entries due, as if time had passed
+    stale = set(random.sample(list(pServer.active_players), int(num_clients * stale_fraction)))
+    for address in stale:
+        pServer.active_players[address].last_ping = now - pServer.client_timeout - 1
+    pServer.timeouts.heap = [(now - 1 if address in stale else deadline, address)
+                             for deadline, address in pServer.timeouts.heap]
+    pServer.timeouts.heap.sort()
+
+    start = time.perf_counter()
+    expired = linear_check_for_timeouts(pServer.active_players, pServer.client_timeout, time.monotonic())
+    linear_expire = (time.perf_counter() - start) * 1e3
+
+    start = time.perf_counter()
+    pServer.check_for_timeouts()
+    heap_expire = (time.perf_counter() - start) * 1e3
+
+    print(f"{num_clients} active clients, {len(expired)} timing out")
+    print("check          | linear scan (ms) | expiry heap (ms)")
+    print(f"nobody due     | {linear_idle:>16.3f} | {heap_idle:>16.4f}")
+    print(f"expire stale   | {linear_expire:>16.3f} | {heap_expire:>16.4f}")
+    print(f"remaining active clients: {len(pServer.active_players)}")
+
+    pServer.close()
+
+
+def bench_wire_formats(repeats=100_000):
+    """
+    Compares packet size and decode time of the text commands against the
+    binary framing, for the password form, the session token form and binary.
+    Decoding includes the schema check, which converts the text fields to ints.
+    """
+    password = f"{12345:064x}"
+    token = "0123456789abcdef"
+    packets = [
+        ("text + password", f"SET_STATS:1,2,3,0 user12345 {password}".encode()),
+        ("text + token", f"SET_STATS:1,2,3,0 {token}".encode()),
+        ("binary", protocol.encode_request("SET_STATS", token, (1, 2, 3, 0), 1)),
+    ]
+    command = server.COMMANDS.get("SET_STATS")
+    print("SET_STATS format | bytes | decode (us)")
+
+    for label, packet in packets:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            if protocol.is_binary(packet):
+                request = protocol.decode_request(packet)
+            else:
+                request = protocol.parse_text_request(packet.decode())
+            command.check(request)
+        elapsed = (time.perf_counter() - start) / repeats * 1e6
+        print(f"{label:<16} | {len(packet):>5} | {elapsed:>11.3f}")
+
+
+def naive_broadcast(pServer, message):
+    # What a broadcast looked like before the Broadcaster: encode and send per recipient
+    for address, data in pServer.active_players.items():
+        pServer.send_bytes(protocol.encode_announcement(message, data.binary), address)
+
+
+def bench_broadcast(sizes=(1_000, 5_000, 20_000), rounds=5):
+    """
+    Time to send one announcement to every active player, sending per
+    recipient against queueing it on the Broadcaster and running a tick.
+    """
+    print("recipients | per-recipient send (ms) | broadcaster tick (ms) | send loop (ms)")
+
+    for size in sizes:
+        pServer = server.Server(port=0)
+        pServer.sl.debug_mode = False
+        for i in range(size):
+            # Nobody listens on these ports, the datagrams are just dropped
+            pServer.start_session(("127.0.0.1", 20_000 + i % 40_000), str(i), player.Player(), binary=i % 2 == 0)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            naive_broadcast(pServer, "Server restarting in 5 minutes")
+        naive = (time.perf_counter() - start) / rounds * 1e3
+
+        send_loop = 0.0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            pServer.announce("Server restarting in 5 minutes")
+            pServer.broadcaster.tick(pServer.active_players, pServer.sock.sendto)
+            send_loop += pServer.broadcaster.last_tick["send_time"]
+        ticked = (time.perf_counter() - start) / rounds * 1e3
+
+        print(f"{size:>10} | {naive:>23.2f} | {ticked:>21.2f} | {send_loop / rounds * 1e3:>14.2f}")
+        pServer.close()
+
+
+def copying_receive(sock):
+    # The receive path before ReceiveRing, kept here as the baseline: a new bytes object per datagram, text decoded at once
+    data, address = sock.recvfrom(4096)
+    if protocol.is_binary(data) or reliable.is_reliable(data):
+        return data, address
+    return data.decode(), address
+
+
+def bench_receive_path(packets=20_000, burst=100):
+    """
+    Receives and parses packets sent over loopback, copying each datagram
+    against reading it into the server's receive ring: time per packet, and
+    bytes allocated per packet (tracemalloc peak with the parsed result alive).
+    """
+    token = "0123456789abcdef"
+    kinds = [
+        ("binary GET_STATS", protocol.encode_request("GET_STATS", token, (7,), 1), protocol.decode_request),
+        ("binary HEARTBEAT", protocol.encode_request("HEARTBEAT", token), protocol.heartbeat_token),
+        ("text HEARTBEAT", f"HEARTBEAT {token}".encode(), protocol.heartbeat_token),
+    ]
+    pServer = server.Server(port=0)
+    pServer.sl.debug_mode = False
+    address = pServer.sock.getsockname()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receivers = [("recvfrom + copy", lambda: copying_receive(pServer.sock)), ("receive ring", pServer.receive_data)]
+
+    def run(receive, parse, packet, count, trace):
+        elapsed = 0.0
+        allocated = 0
+        for _ in range(count // burst):
+            for _ in range(burst):
+                sender.sendto(packet, address)
+            start = time.perf_counter()
+            for _ in range(burst):
+                if trace:
+                    tracemalloc.reset_peak()
+                    before = tracemalloc.get_traced_memory()[0]
+                data, _ = receive()
+                result = parse(data)
+                if trace:
+                    allocated += tracemalloc.get_traced_memory()[1] - before
+            elapsed += time.perf_counter() - start
+        return elapsed, allocated
+
+    print("packet           | receive path    | receive + parse (us) | allocated (bytes)")
+    for label, packet, parse in kinds:
+        for name, receive in receivers:
+            elapsed, _ = run(receive, parse, packet, packets, False)
+            tracemalloc.start()
+            _, allocated = run(receive, parse, packet, packets // 10, True)
+            tracemalloc.stop()
+            print(f"{label:<16} | {name:<15} | {elapsed / packets * 1e6:>20.3f} | "
+                  f"{allocated / (packets // 10):>17.1f}")
+
+    sender.close()
+    pServer.close()
+
+
+def make_combatants(simulation, stats):
+    players = []
+    for i, values in enumerate(stats):
+        pPlayer = player.Player()
+        pPlayer.init_stats(*values)
+        simulation.join(str(i + 1), pPlayer)
+        players.append(pPlayer)
+    return players
+
+
+def bench_combat(sizes=(1_000, 10_000, 100_000), steps=5):
+    """
+    Time to resolve a combat step in which every combatant acts, with a use()
+    call per action against the NumPy resolver. Both start from the same
+    players and actions and must end in the same state.
+    """
+    if not combat.HAVE_NUMPY:
+        print("bench_combat needs numpy, skipped")
+        return
+    print("combatants | use() per action (ms/step) | numpy (ms/step) | same result")
+
+    for size in sizes:
+        rng = random.Random(size)
+        stats = [(rng.randint(1, 40), rng.randint(0, 10), rng.randint(1, 40), rng.randint(0, 30))
+                 for _ in range(size)]
+        rounds = [[(str(i), rng.randrange(len(combat.ITEMS)), str(rng.randint(1, size))) for i in range(1, size + 1)]
+                  for _ in range(steps)]
+
+        timings = []
+        results = []
+        for simulation in (combat.CombatSimulation(), combat.ArrayCombatSimulation()):
+            players = make_combatants(simulation, stats)
+            elapsed = 0.0
+            for actions in rounds:
+                for player_id, item, target_id in actions:
+                    simulation.queue(player_id, item, target_id)
+                start = time.perf_counter()
+                simulation.step()
+                elapsed += time.perf_counter() - start
+            timings.append(elapsed / steps * 1e3)
+            results.append([(pPlayer.health, pPlayer.lives) for pPlayer in players])
+
+        print(f"{size:>10} | {timings[0]:>26.2f} | {timings[1]:>15.2f} | {results[0] == results[1]}")
+
+
+def plain_class(*fields):
+    # A class keeping fields in a per-instance __dict__, as the player classes did before __slots__
+    def __init__(self, *values):
+        for field, value in zip(fields, values):
+            setattr(self, field, value)
+    return type("Plain", (), {"__init__": __init__})
+
+
+PlainItem = plain_class("name", "stat")
+PlainPotion = plain_class("name", "effect", "strength")
+PlainProfile = plain_class("username", "password", "avatar")
+PlainInventory = plain_class("sword", "shield", "slaying_potion", "healing_potion")
+PlainPlayer = plain_class("profile", "inventory", "lives", "health")
+PlainStateSync = plain_class("snapshot_every", "resend_every", "seq", "acked_seq", "acked_state", "sent",
+                             "last_sent", "ticks_since_send", "ticks_since_snapshot")
+
+
+def dict_session(username, password, player_id, token, binary):
+    # An active_players entry before Session and __slots__, kept here as the baseline
+    inventory = PlainInventory(PlainItem("Basic Sword", 5), PlainItem("Basic Shield", 6),
+                               PlainPotion("Slaying Potion", player.Potion.Effect.SLAYING, 7),
+                               PlainPotion("Healing Potion", player.Potion.Effect.HEALING, 8))
+    pPlayer = PlainPlayer(PlainProfile(username, password, None), inventory, 2, player.MAX_HEALTH)
+    return {"player": pPlayer, "player_id": player_id, "token": token, "last_ping": time.monotonic(),
+            "binary": binary, "sync": PlainStateSync(100, 5, 0, 0, None, OrderedDict(), None, 0, 0)}
+
+
+def slotted_session(username, password, player_id, token, binary):
+    pPlayer = player.Player()
+    pPlayer.create_profile(username, password)
+    pPlayer.init_stats(5, 6, 7, 8)
+    return server.Session(pPlayer, player_id, token, binary)
+
+
+def bench_session_memory(num_sessions=100_000):
+    """
+    Bytes per active player for num_sessions sessions, dict sessions of
+    __dict__ objects against slotted Sessions and Players. Measured with
+    tracemalloc (everything allocated, including the usernames, passwords,
+    tokens and addresses both share) and with server.deep_size as in
+    Server.memory_per_player.
+    """
+    print("representation      | tracemalloc (bytes/player) | deep_size (bytes/player)")
+
+    for label, make_session in (("dict + __dict__", dict_session), ("Session + __slots__", slotted_session)):
+        gc.collect()
+        tracemalloc.start()
+        active_players = {}
+        for i in range(num_sessions):
+            address = (f"10.{i >> 16}.{(i >> 8) & 255}.{i & 255}", 20_000 + i % 40_000)
+            active_players[address] = make_session(f"user{i}", f"{i:064x}", str(i + 1), secrets.token_hex(8), i % 2 == 0)
+        gc.collect()
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        seen = set()
+        measured = sum(server.deep_size(address, seen) + server.deep_size(data, seen)
+                       for address, data in active_players.items())
+        print(f"{label:<19} | {allocated / num_sessions:>26.0f} | {measured / num_sessions:>24.0f}")
+        del active_players
+
+
+def own_items(pPlayer, stats):
+    # Before the catalog every player got four item objects of their own, kept here as the baseline
+    inventory = pPlayer.inventory
+    inventory.sword = player.Sword(inventory.sword.template, stats[0])
+    inventory.shield = player.Shield(inventory.shield.template, stats[1])
+    inventory.slaying_potion = player.Potion(inventory.slaying_potion.template, stats[2])
+    inventory.healing_potion = player.Potion(inventory.healing_potion.template, stats[3])
+
+
+def shared_items(pPlayer, stats):
+    pPlayer.init_stats(*stats)
+
+
+def bench_login_items(num_players=100_000):
+    """
+    Building the Players of num_players LOGINs, with stats as the stat selector
+    hands them out (0-3): time and bytes per player when each gets item
+    objects of its own against the catalog's shared items.
+    """
+    rng = random.Random(num_players)
+    stats = [tuple(rng.randint(0, 3) for _ in range(4)) for _ in range(num_players)]
+    print("items       | per LOGIN (us) | bytes/player")
+
+    for label, give_items in (("own objects", own_items), ("catalog", shared_items)):
+        start = time.perf_counter()
+        for values in stats:
+            give_items(player.Player(), values)
+        elapsed = (time.perf_counter() - start) / num_players * 1e6
+
+        gc.collect()
+        tracemalloc.start()
+        players = []
+        for values in stats:
+            pPlayer = player.Player()
+            give_items(pPlayer, values)
+            players.append(pPlayer)
+        gc.collect()
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{label:<11} | {elapsed:>14.2f} | {allocated / num_players:>12.0f}")
+        del players
+
+
+def scan_nearby(positions, x, y, radius):
+    # Before the grid finding the players near one meant looking at all of them, kept here as the baseline
+    max_distance = radius * radius
+    return [(key, (key_x - x) ** 2 + (key_y - y) ** 2) for key, (key_x, key_y) in positions.items()
+            if (key_x - x) ** 2 + (key_y - y) ** 2 <= max_distance]
+
+
+def bench_area_of_interest(sizes=(1_000, 10_000, 100_000), radius=150, per_area=10, queries=500):
+    """
+    Players spread over a world that grows with them, about per_area within
+    radius of anyone. Per client: finding its neighbours by scanning every
+    player against the spatial grid, and the nearby push it gets when sent
+    everyone against only its area of interest. Also the cost of a move.
+    """
+    print("players | scan (us) | grid (us) | neighbours | push, everyone (bytes) | push, area (bytes) | move (us)")
+
+    for num_players in sizes:
+        rng = random.Random(num_players)
+        side = int((num_players * 3.14159 * radius * radius / per_area) ** 0.5)
+        positions = {i: (rng.randrange(side), rng.randrange(side)) for i in range(num_players)}
+        grid = spatial.SpatialGrid(cell_size=radius)
+        for key, (x, y) in positions.items():
+            grid.insert(key, x, y)
+        clients = rng.sample(range(num_players), min(queries, num_players))
+
+        scan_queries = clients[:max(1, queries * 1_000 // num_players)]  # The scan is too slow to run them all
+        start = time.perf_counter()
+        for key in scan_queries:
+            scan_nearby(positions, *positions[key], radius)
+        scan_time = (time.perf_counter() - start) / len(scan_queries) * 1e6
+
+        start = time.perf_counter()
+        for key in clients:
+            grid.near(*positions[key], radius)
+        grid_time = (time.perf_counter() - start) / len(clients) * 1e6
+
+        entry = (str(num_players), 1000, 1000, player.MAX_HEALTH)
+        neighbours = 0
+        push_bytes = 0
+        for key in clients:
+            found = len(grid.near(*positions[key], radius)) - 1  # Not counting the client itself
+            neighbours += found
+            push_bytes += len(protocol.encode_nearby(1, [entry] * min(found, protocol.MAX_NEARBY), True))
+        everyone_bytes = len(protocol.encode_nearby(1, [], True)) + protocol.NEARBY_ENTRY.size * (num_players - 1)
+
+        steps = [(key, rng.randint(-10, 10), rng.randint(-10, 10)) for key in clients]
+        start = time.perf_counter()
+        for key, dx, dy in steps:
+            x, y = positions[key]
+            grid.move(key, x + dx, y + dy)
+        move_time = (time.perf_counter() - start) / len(steps) * 1e6
+
+        print(f"{num_players:>7} | {scan_time:>9.1f} | {grid_time:>9.1f} | {neighbours / len(clients):>10.1f} | "
+              f"{everyone_bytes:>22} | {push_bytes / len(clients):>18.0f} | {move_time:>9.2f}")
+
+
+if __name__ == "__main__":
+    bench_username_lookup()
+    bench_client_timeouts()
+    bench_wire_formats()
+    bench_broadcast()
+    bench_receive_path()
+    bench_combat()
+    bench_session_memory()
+    bench_login_items()
+    bench_area_of_interest()
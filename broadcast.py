@@ -0,0 +1,131 @@
+# broadcast.py
+# Fan-out of server messages to many active players, once per server tick
+
+import time
+from collections import deque
+
+
+class Broadcaster:
+    """
+    Queues messages for many recipients and sends them out once per tick.
+
+    A message is encoded once per wire format by the caller and every
+    recipient's queue holds a reference to the same packet. Each tick drains
+    the queues under a per-client token bucket (rate packets per second,
+    bursts of up to burst) and sends everything in one tight loop. Queues are
+    capped at max_queue, dropping the oldest packets when a client falls too
+    far behind.
+    """
+
+    def __init__(self, rate=20.0, burst=10, max_queue=64):
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.pending = []  # (text_packet, binary_packet, recipients) broadcast since the last tick
+        self.queues = {}  # address -> deque of (enqueued_at, packet)
+        self.buckets = {}  # address -> [tokens, last_refill]
+        self.totals = {"messages": 0, "packets": 0, "bytes": 0, "dropped": 0, "errors": 0}
+        self.last_tick = {}  # Metrics of the most recent tick that had anything to send
+
+    def broadcast(self, text_packet, binary_packet=None, recipients=None):
+        """
+        Queues a message for recipients (client addresses), or for every active
+        player if None. Binary sessions get binary_packet when there is one.
+        """
+        self.pending.append((text_packet, binary_packet, recipients))
+        self.totals["messages"] += 1
+
+    def forget(self, address):
+        self.queues.pop(address, None)
+        self.buckets.pop(address, None)
+
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def tick(self, active_players, sendto, now=None):
+        """
+        Sends this tick's broadcasts and whatever the rate limits now allow of
+        earlier ones. sendto(packet, address) does the sending.
+        """
+        if now is None:
+            now = time.monotonic()
+        if not self.queues and not self.pending:
+            return
+
+        outgoing = []
+        max_latency = self.drain(active_players, now, outgoing) if self.queues else 0.0
+        if self.pending:
+            self.expand(active_players, now, outgoing)
+
+        start = time.perf_counter()
+        sent_bytes = 0
+        errors = 0
+        for packet, address in outgoing:
+            try:
+                sendto(packet, address)
+                sent_bytes += len(packet)
+            except OSError:
+                errors += 1
+        send_time = time.perf_counter() - start
+
+        self.totals["packets"] += len(outgoing) - errors
+        self.totals["bytes"] += sent_bytes
+        self.totals["errors"] += errors
+        self.last_tick = {
+            "packets": len(outgoing) - errors,
+            "bytes": sent_bytes,
+            "send_time": send_time,  # Seconds spent in the send loop
+            "max_latency": max_latency,  # Seconds the oldest packet sent had waited in a queue
+            "queue_depth": self.queue_depth(),  # Packets still held back by rate limits
+        }
+
+    def refill(self, address, now):
+        bucket = self.buckets.get(address)
+        if bucket is None:
+            bucket = self.buckets[address] = [self.burst, now]
+        elif bucket[1] != now:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def drain(self, active_players, now, outgoing):
+        # Sends queued packets of clients that were rate limited earlier, oldest first
+        max_latency = 0.0
+        for address in list(self.queues):
+            if address not in active_players:
+                self.forget(address)
+                continue
+            queue = self.queues[address]
+            bucket = self.refill(address, now)
+            allowed = min(int(bucket[0]), len(queue))
+            bucket[0] -= allowed
+            for _ in range(allowed):
+                enqueued_at, packet = queue.popleft()
+                outgoing.append((packet, address))
+                max_latency = max(max_latency, now - enqueued_at)
+            if not queue:
+                del self.queues[address]
+        return max_latency
+
+    def expand(self, active_players, now, outgoing):
+        # Clients with no backlog and a token to spare get the packet straight away, the rest queue it
+        queues = self.queues
+        for text_packet, binary_packet, recipients in self.pending:
+            for address in (active_players if recipients is None else recipients):
+                data = active_players.get(address)  # The recipient's Session
+                if data is None:
+                    continue
+                packet = binary_packet if binary_packet is not None and data.binary else text_packet
+                queue = queues.get(address)
+                if queue is None:
+                    bucket = self.refill(address, now)
+                    if bucket[0] >= 1:
+                        bucket[0] -= 1
+                        outgoing.append((packet, address))
+                        continue
+                    queue = queues[address] = deque()
+                elif len(queue) >= self.max_queue:
+                    queue.popleft()
+                    self.totals["dropped"] += 1
+                queue.append((now, packet))
+        self.pending = []
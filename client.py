@@ -1,30 +1,265 @@
 # client.py
 
 import pygame, player, player_ui, platform
-import socket
+import socket, time, secrets, os
+import protocol, reliable, sync
+from ring import ReceiveRing
+from combat import ITEMS
 
 from logger import ClientLogger
 
+STATS_CACHE_DIR = "stats_cache"  # Last stats received per account, saved with Player.save_inventory
+
 
 class Client:
     # --- Client class (no changes) ---
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, use_reliable=False):
         self.server_address = (server_ip, server_port)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.response_timeout = 5.0  # Seconds receive_data waits when not using the reliable layer
+        self.sock.settimeout(self.response_timeout)
+        self.receive_ring = ReceiveRing(slots=4)  # Replies and pushes are read into these, see ring.py
         self.player = player.Player()
         self.cl = ClientLogger()
+        self.session_token = None  # Issued by the server in LOGIN_SUCCESS
+        self.binary = False  # Set when the server accepted the binary protocol at LOGIN
+        self.next_request_id = 0
+        self.prefetched = {}  # Replies that came back in a batch before they were asked for, by command
+        # Optional reliable layer: each request gets a sequence number and is
+        # retransmitted until the server's reply acks it
+        self.use_reliable = use_reliable
+        # Random start, so requests from a restarted client on a reused port don't line up with retransmits
+        # of the old one's. The server takes a number far below the last one it saw as a restart.
+        self.next_seq = secrets.randbelow(1 << 30)
+        self.pending = None  # (seq, packet) of the request awaiting its reply
+        self.rtt = reliable.RttEstimator()
+        self.max_retransmits = 4
+        self.stats_version = 0  # Version of the stats in self.player, 0 if they are not from the server
+        self.state = sync.StateReceiver()  # Player state pushed by the server after LOGIN
+        self.nearby = {}  # player_id -> (x, y, health) of the other players in our area of interest
+        self.nearby_seq = 0  # seq of the nearby players push self.nearby came from
+        self.heartbeat_interval = 5.0  # Replaced by the interval the server sends in LOGIN_SUCCESS
+        self.last_send = time.monotonic()  # Any packet to the server counts as a heartbeat
+
+    def auth_fields(self, username, password):
+        # Once logged in, the session token stands in for username + password
+        if self.session_token:
+            return self.session_token
+        return f"{username} {password}"
+
+    def send_command(self, command, username, password, *fields):
+        """
+        Sends a command for the logged in player, as a binary packet when the
+        server accepted it and as text otherwise. fields are ints (SET_STATS).
+        """
+        if self.binary and self.session_token:
+            self.next_request_id = (self.next_request_id + 1) % 0x10000
+            message = protocol.encode_request(command, self.session_token, fields, self.next_request_id)
+        else:
+            message = self.command_line(command, username, password, *fields).encode()
+        # Heartbeats, acks and moves get no reply to wait for, and the next one replaces a lost one
+        self.send_bytes(message, track=command not in ("HEARTBEAT", "STATE_ACK", "NEARBY_ACK", "MOVE"))
+
+    def command_line(self, command, username, password, *fields):
+        # Text form of a command, e.g. "SET_STATS:1,2,3,4 <token>"
+        if fields:
+            command = f"{command}:{','.join(str(value) for value in fields)}"
+        return f"{command} {self.auth_fields(username, password)}"
+
+    def send_batch(self, commands):
+        """
+        Sends several text commands in one datagram. The server answers them
+        all in one datagram too, which receive_reply unpacks.
+        """
+        self.prefetched.clear()
+        self.send_data(protocol.join_batch(commands))
+
+    def receive_reply(self, command):
+        """
+        Returns the reply to command, taking it from an earlier batch if it
+        already arrived and receiving otherwise.
+        """
+        if command in self.prefetched:
+            return self.prefetched.pop(command)
+        response = self.receive_data()
+        if response is None or not protocol.is_batch(response):
+            return response
+        for reply in protocol.split_batch(response):
+            self.prefetched[protocol.reply_command(reply)] = reply
+        return self.prefetched.pop(command, None)
+
+    def request(self, command, username, password, *fields):
+        # Sends command unless its reply was already batched with an earlier one
+        if command not in self.prefetched:
+            self.send_command(command, username, password, *fields)
+        return self.receive_reply(command)
+
+    def use_item(self, item, target_id=0):
+        """
+        Uses an item ("sword", "shield", ...) on the player target_id, or on
+        this player for 0, in the server's next combat step. The reply only says
+        the action was queued; health and lives change with a later state push.
+        """
+        return self.request("USE_ITEM", None, None, ITEMS.index(item), target_id)
+
+    def move(self, dx, dy):
+        # Steps this player, the server clamps the step and pushes back where we ended up
+        self.send_command("MOVE", None, None, dx, dy)
+
+    def stats_cache_path(self, username):
+        host, port = self.server_address
+        return os.path.join(STATS_CACHE_DIR, f"{username}@{host}_{port}.json")
+
+    def load_cached_stats(self, username):
+        """
+        Loads the stats cached for username into self.player and returns their
+        version, 0 if there is no usable cache.
+        """
+        try:
+            version = self.player.load_inventory(self.stats_cache_path(username))
+        except (FileNotFoundError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                self.cl.warning(f"Ignoring unreadable stats cache: {e}")
+            version = None
+        self.stats_version = version or 0
+        return self.stats_version
+
+    def save_cached_stats(self, username, version):
+        try:
+            os.makedirs(STATS_CACHE_DIR, exist_ok=True)
+            self.player.save_inventory(self.stats_cache_path(username), version)
+            self.stats_version = version
+        except OSError as e:
+            self.cl.error(f"Error saving stats cache: {e}")
 
     def send_data(self, data):
+        self.send_bytes(data.encode())
+
+    def maybe_heartbeat(self):
+        # Only needed when nothing else was sent for a heartbeat interval
+        if self.session_token and time.monotonic() - self.last_send >= self.heartbeat_interval:
+            self.send_command("HEARTBEAT", None, None)
+
+    def send_bytes(self, message, track=True):
+        if self.use_reliable and track:
+            self.next_seq = (self.next_seq + 1) % (1 << 32)
+            message = reliable.wrap(reliable.FLAG_DATA, self.next_seq, message)
+            self.pending = (self.next_seq, message)
         try:
-            message = data.encode()
             self.sock.sendto(message, self.server_address)
+            self.last_send = time.monotonic()
         except Exception as e:
             self.cl.error(f"Error sending data: {e}")
 
+    def await_reply(self):
+        """
+        Waits for the reply acking the pending request, retransmitting it each
+        time the RTO runs out, at most max_retransmits times. Returns the reply
+        payload (empty for a bare ack), or None if the server never answered.
+        """
+        seq, packet = self.pending
+        self.pending = None
+        sent_at = time.monotonic()
+        rto = self.rtt.rto
+
+        try:
+            for attempt in range(self.max_retransmits + 1):
+                reply = self.receive_ack(seq, time.monotonic() + rto)
+                if reply is not None:
+                    if attempt == 0:
+                        self.rtt.update(time.monotonic() - sent_at)
+                    return reply
+
+                if attempt < self.max_retransmits:
+                    rto = self.rtt.backoff()
+                    self.cl.warning(f"No reply to message {seq}, retransmitting (timeout {rto:.2f}s)")
+                    self.sock.sendto(packet, self.server_address)
+        finally:
+            self.sock.settimeout(self.response_timeout)
+
+        self.cl.error(f"Server did not answer message {seq} after {self.max_retransmits} retransmits.")
+        return None
+
+    def receive_ack(self, seq, deadline):
+        # Returns the payload of the packet acking seq, or None if none came before deadline
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data, _ = self.receive_ring.recv(self.sock)
+            except socket.timeout:
+                return None
+            reply = reliable.unwrap(data)
+            if reply is not None and reply[1] == seq and reply[0] & reliable.FLAG_ACK:
+                return reply[2]
+            if protocol.is_push(data):
+                self.handle_push(data)
+            # Otherwise a late reply to an earlier request, already dealt with
+
+    def handle_push(self, data):
+        """
+        Handles a packet the server sent unasked: announcements are logged,
+        nearby players replace self.nearby and state pushes are applied to
+        self.player, both acked.
+        """
+        if protocol.is_announcement(data):
+            self.cl.log(f"Server announcement: {protocol.decode_announcement(data)}")
+            return
+        if protocol.is_nearby(data):
+            try:
+                seq, entries = protocol.decode_nearby(data)
+            except ValueError as e:
+                self.cl.warning(f"Ignoring nearby push: {e}")
+                return
+            if seq >= self.nearby_seq:  # Older ones arrived out of order
+                self.nearby = {player_id: (x, y, health) for player_id, x, y, health in entries}
+                self.nearby_seq = seq
+                self.send_command("NEARBY_ACK", None, None, seq)
+            return
+        try:
+            seq, base_seq, changes = protocol.decode_state(data)
+        except ValueError as e:
+            self.cl.warning(f"Ignoring state push: {e}")
+            return
+        state = self.state.apply(seq, base_seq, changes)
+        if state is not None:
+            sync.apply_state(self.player, state)
+            self.send_command("STATE_ACK", None, None, seq)
+
+    def poll_pushes(self):
+        # Applies any state pushes waiting on the socket, without blocking
+        self.sock.setblocking(False)
+        try:
+            while True:
+                try:
+                    data, _ = self.receive_ring.recv(self.sock)
+                except BlockingIOError:
+                    break
+                if protocol.is_push(data):
+                    self.handle_push(data)
+        except OSError as e:
+            self.cl.error(f"Error receiving data: {e}")
+        finally:
+            self.sock.settimeout(self.response_timeout)
+
     def receive_data(self):
         try:
-            data, _ = self.sock.recvfrom(4096)
-            return data.decode()
+            if self.pending is not None:
+                data = self.await_reply()
+                if data is None:
+                    return None
+            else:
+                data, _ = self.receive_ring.recv(self.sock)
+                while protocol.is_push(data):
+                    self.handle_push(data)
+                    data, _ = self.receive_ring.recv(self.sock)
+            if protocol.is_binary(data):
+                # Binary replies are turned back into their text form for the callers
+                name, fields, _ = protocol.decode_response(data)
+                return protocol.format_text_response(name, fields)
+            return str(data, "utf-8")
         except Exception as e:
             self.cl.error(f"Error receiving data: {e}")
             return None
@@ -109,14 +344,29 @@ def run_login_screen(screen, client, login_ui, ret_info, cl):
 
                 # Send the correct command based on the button pressed
                 if action == 'login':
-                    client.send_data(f"LOGIN {username} {password}")
+                    # Ask for the login count and stats in the same datagram, so the game
+                    # can start after a single round trip. Stats are only sent back if
+                    # they changed since the version cached locally.
+                    version = client.load_cached_stats(username)
+                    client.send_batch([
+                        f"LOGIN {username} {password} {protocol.BINARY_TAG}",
+                        f"LOGINS {username} {password}",
+                        f"GET_STATS:{version} {username} {password}",
+                    ])
+                    response = client.receive_reply("LOGIN")
                 elif action == 'signup':
                     client.send_data(f"SIGNUP {username} {password}")
-
-                response = client.receive_data()
+                    response = client.receive_reply("SIGNUP")
 
                 # Check if the response means we are logged in
                 if handle_login_response(response, cl):
+                    # LOGIN_SUCCESS <player_id> <session_token> [BIN/4] [HB/<seconds>]
+                    fields = response.split()
+                    client.session_token = fields[2] if len(fields) > 2 else None
+                    client.binary = protocol.BINARY_TAG in fields[3:]
+                    for tag in fields[3:]:
+                        if tag.startswith(protocol.HEARTBEAT_TAG):
+                            client.heartbeat_interval = float(tag[len(protocol.HEARTBEAT_TAG):])
                     ret_info.append(username)
                     ret_info.append(password)
                     return True  # Login was successful!
@@ -152,15 +402,41 @@ def run_stats_selector(screen, client, stats_ui, cl):
     return False  # Should only be reached if loop exits abnormally
 
 
+def choose_stats(screen, client, username, password, cl):
+    """
+    Runs the stats selector and sends the choice to the server, bringing the
+    selector up again until the server takes it. Returns False if the player
+    quit instead.
+    """
+    while True:
+        stats_ui = player_ui.StatSelectUI()
+        stats_result = run_stats_selector(screen, client, stats_ui, cl)
+        if stats_result is None:
+            cl.error(f"{username} quit during stats selection.")
+            return False
+        sword_damage, shield_defense, slaying_strength, healing_strength = stats_result
+        # Set the stats and read them back in the same round trip
+        client.send_batch([
+            client.command_line("SET_STATS", username, password,
+                                sword_damage, shield_defense, slaying_strength, healing_strength),
+            client.command_line("GET_STATS", username, password, client.stats_version),
+        ])
+        stats_response = client.receive_reply("SET_STATS")
+        if stats_response and stats_response.startswith("SET_STATS_SUCCESS"):
+            cl.log(f"{username} stats set successfully on server.")
+            return True
+        cl.error(f"Failed to set {username} stats on server. Retrying...")
+
+
 def client_heartbeat(client, cl):
     """
-    Sends periodic ALIVE pings to the server to maintain connection.
+    Keeps the session alive. Any packet to the server does that, so a
+    heartbeat only goes out after a quiet heartbeat interval.
     """
     try:
-        client.send_data(f"HEARTBEAT NONE NONE")
-        cl.info("Sent ALIVE ping to server.")
+        client.maybe_heartbeat()
     except Exception as e:
-        cl.error(f"Error sending ALIVE ping: {e}")
+        cl.error(f"Error sending heartbeat: {e}")
 
 
 def run_game_loop(screen, client, game_ui, cl):
@@ -168,33 +444,32 @@ def run_game_loop(screen, client, game_ui, cl):
     Runs the main game loop after the player is logged in.
     """
     running = True
-
-
-    should_heartbeat = pygame.USEREVENT + 1
-    pygame.time.set_timer(should_heartbeat, 5000)  # Every 5
+    # Arrow keys move the player, one full step (the server's max_step) per press
+    move_keys = {pygame.K_LEFT: (-10, 0), pygame.K_RIGHT: (10, 0), pygame.K_UP: (0, -10), pygame.K_DOWN: (0, 10)}
 
     while running:
         # --- Event Loop ---
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.KEYDOWN and event.key in move_keys:
+                client.move(*move_keys[event.key])
 
-            if event.type == should_heartbeat:
-                client_heartbeat(client, cl)
+        # Pick up state changes and announcements pushed by the server
+        client.poll_pushes()
+        client_heartbeat(client, cl)
 
         game_ui.draw()
 
     cl.log("Game loop ended.")
 
 
-#TODO: Add a response timeout for server communications
-
 def main():
     """Main function to initialize and run the client."""
     pygame.init()
     screen = pygame.display.set_mode((800, 600))
     login_ui = player_ui.LoginUI()
-    client = Client('localhost', 9999)
+    client = Client('localhost', 9999, use_reliable=True)
     cl = client.cl
 
     try:
@@ -206,48 +481,45 @@ def main():
         # Step 2: If login was successful, run the game
         if login_successful:
             cl.log("Moving to game loop...")
-            cl.info(f"LOGINS {result[0]} {result[1]}")
-            client.send_data(f"LOGINS {result[0]} {result[1]}")
-
-            while True:
-                response = client.receive_data()
-                login_count = handle_login_counter(response, cl)
-                if response is not None and login_count <= 1:
-                    stats_ui = player_ui.StatSelectUI()
-                    stats_result = run_stats_selector(screen, client, stats_ui, cl)
-                    if stats_result is None:
-                        cl.error(f"{result[0]} quit during stats selection.")
-                        return
-                    sword_damage, shield_defense, slaying_strength, healing_strength = stats_result
-                    client.send_data(
-                        f"SET_STATS:{sword_damage},{shield_defense},{slaying_strength},{healing_strength}" +
-                        f" {result[0]} {result[1]}")
-                    stats_response = client.receive_data()
-                    if stats_response and stats_response.startswith("SET_STATS_SUCCESS"):
-                        cl.log(f"{result[0]} stats set successfully on server.")
-                        break
-                    else:
-                        cl.error(f"Failed to set {result[0]} stats on server. Retrying...")
-                else:
-                    break
-
+            cl.info(f"LOGINS {client.auth_fields(result[0], result[1])}")
 
-            # Request player stats from server
-            client.send_data(f"GET_STATS {result[0]} {result[1]}")
+            # Usually already here from the LOGIN batch
+            response = client.request("LOGINS", result[0], result[1])
+            login_count = handle_login_counter(response, cl)
+            stats_chosen = response is not None and login_count <= 1
+            if stats_chosen and not choose_stats(screen, client, result[0], result[1], cl):
+                return
 
+            # Request player stats from server, unless a batch already brought them. Failures are
+            # final, asking again would only get the same answer.
             while True:
-                stats_response = client.receive_data()
-                if stats_response and stats_response.startswith("GET_STATS_SUCCESS"):
+                stats_response = client.request("GET_STATS", result[0], result[1], client.stats_version)
+                if stats_response and stats_response.startswith("GET_STATS_NOT_MODIFIED"):
+                    # The stats loaded from the cache at login are current
+                    cl.log(f"Cached player stats are up to date (version {client.stats_version}).")
+                    break
+                elif stats_response and stats_response.startswith("GET_STATS_SUCCESS"):
                     try:
-                        stats_data = stats_response.split()[1]
+                        stats_data, version = stats_response.split()[1:3]
                         sword_damage, shield_defense, slaying_strength, healing_strength = map(int, stats_data.split(','))
                         client.player.init_stats(sword_damage, shield_defense, slaying_strength, healing_strength)
                         cl.log(f"Received player stats from server: {stats_data}")
+                        client.save_cached_stats(result[0], int(version))
                         break
                     except (IndexError, ValueError):
                         cl.error("Error parsing player stats from server response.")
+                        return
+                elif stats_response is None:
+                    cl.error("No response from server, giving up.")
+                    return
+                elif stats_response.startswith("GET_STATS_FAIL No stats found") and not stats_chosen:
+                    # Stats selection was quit at the first login, and the login count no longer brings it up
+                    if not choose_stats(screen, client, result[0], result[1], cl):
+                        return
+                    stats_chosen = True
                 else:
-                    cl.error("Failed to receive player stats from server.")
+                    cl.error(f"Failed to receive player stats from server: {stats_response}")
+                    return
 
 
             gm = player_ui.GameUI(client.player)
@@ -0,0 +1,230 @@
+# combat.py
+# Server-authoritative combat: item uses queued by players, resolved in fixed timestep steps
+
+import time
+import player
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Only ArrayCombatSimulation needs it
+HAVE_NUMPY = np is not None
+
+# Inventory attribute of each usable item, indexed by the item number USE_ITEM sends
+ITEMS = ("sword", "shield", "slaying_potion", "healing_potion")
+SIGNS = (-1, 1, -1, 1)  # Direction each item's use() moves the target's health in
+
+
+def item_stats(pPlayer):
+    # The stat each of ITEMS applies, in ITEMS order
+    inventory = pPlayer.inventory
+    return (inventory.sword.damage, inventory.shield.defense, inventory.slaying_potion.strength,
+            inventory.healing_potion.strength)
+
+
+def array_stats(pPlayer):
+    # item_stats limited to the int32 range SET_STATS accepts, so stats saved before it was checked
+    # still fit the int64 arrays (and their sums over many attackers can't overflow)
+    return [min(max(stat, -(1 << 31)), (1 << 31) - 1) for stat in item_stats(pPlayer)]
+
+
+class CombatSimulation:
+    """
+    Resolves the item uses players queue, in steps of a fixed timestep that do
+    not depend on when packets arrive. Each player has at most one action per
+    step, a newer one replacing the one still queued, so a step costs at most
+    one use() per combatant however fast clients send.
+
+    All actions of a step see the same starting state: every use() is applied
+    first and deaths are settled afterwards, so arrival order within a step
+    doesn't matter. Nothing is sent from here, the next state push carries
+    each player's health and lives.
+    """
+
+    def __init__(self, timestep=0.1, max_steps=5):
+        self.timestep = timestep
+        self.max_steps = max_steps  # Steps run at most per advance(), so a stalled server skips ahead instead of piling up
+        self.combatants = {}  # player_id -> Player
+        self.actions = {}  # player_id -> (item, target_id), for the next step
+        self.next_step = None  # Monotonic time the next step is due
+        self.steps = 0
+        self.totals = {"actions": 0, "replaced": 0, "deaths": 0, "skipped_steps": 0, "step_time": 0.0}
+
+    def join(self, player_id, pPlayer):
+        self.combatants[player_id] = pPlayer
+
+    def leave(self, player_id, pPlayer):
+        # Only if pPlayer is still the one fighting, the account may have logged in again elsewhere
+        if self.combatants.get(player_id) is pPlayer:
+            del self.combatants[player_id]
+            self.actions.pop(player_id, None)
+
+    def refresh(self, player_id):
+        pass  # Item stats are read from the Players when used, nothing to copy
+
+    def queue(self, player_id, item, target_id):
+        """
+        Queues player_id using item (an index into ITEMS) on target_id for the
+        next step. Returns False if either player can't take part.
+        """
+        attacker = self.combatants.get(player_id)
+        target = self.combatants.get(target_id)
+        if attacker is None or target is None or attacker.lives <= 0 or target.lives <= 0:
+            return False
+        if player_id in self.actions:
+            self.totals["replaced"] += 1
+        self.actions[player_id] = (ITEMS[item], target_id)
+        self.totals["actions"] += 1
+        return True
+
+    def advance(self, now=None):
+        """
+        Runs every step that has come due by now. Returns how many ran.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.next_step is None:
+            self.next_step = now
+        steps = 0
+        while self.next_step <= now:
+            if steps == self.max_steps:
+                missed = int((now - self.next_step) / self.timestep) + 1
+                self.totals["skipped_steps"] += missed
+                self.next_step += missed * self.timestep
+                break
+            self.step()
+            self.next_step += self.timestep
+            steps += 1
+        return steps
+
+    def step(self):
+        start = time.perf_counter()
+        actions, self.actions = self.actions, {}
+        combatants = self.combatants
+        hit = set()
+        for player_id, (item, target_id) in actions.items():
+            target = combatants.get(target_id)
+            if target is None:
+                continue  # Left since the action was queued
+            getattr(combatants[player_id].inventory, item).use(target)
+            hit.add(target_id)
+        for target_id in hit:
+            self.settle(combatants[target_id])
+        self.steps += 1
+        self.totals["step_time"] += time.perf_counter() - start
+
+    def settle(self, target):
+        # A player at 0 health loses a life and comes back at full health, until the lives run out
+        if target.health <= 0:
+            target.lives = max(target.lives - 1, 0)
+            target.health = player.MAX_HEALTH if target.lives > 0 else 0
+            self.totals["deaths"] += 1
+        elif target.health > player.MAX_HEALTH:
+            target.health = player.MAX_HEALTH
+
+
+class ArrayCombatSimulation(CombatSimulation):
+    """
+    CombatSimulation that keeps every combatant's health, lives, item stats and
+    queued action in NumPy arrays indexed by a slot number, and resolves a step
+    with one vectorized scatter-add instead of a use() call per action. Results
+    are identical to the use() methods for stats in the range SET_STATS accepts.
+
+    While a player fights the arrays hold their health and lives. After each
+    step the new values are copied back to the Players that were hit, so state
+    pushes keep reading Players. Item stats are copied in on join and again by
+    refresh() after SET_STATS.
+    """
+
+    def __init__(self, timestep=0.1, max_steps=5, capacity=1024):
+        if np is None:
+            raise ImportError("ArrayCombatSimulation needs numpy")
+        super().__init__(timestep, max_steps)
+        self.slots = {}  # player_id -> slot
+        self.players = [None] * capacity  # slot -> Player
+        self.free = list(range(capacity - 1, -1, -1))
+        self.health = np.zeros(capacity, np.int64)
+        self.lives = np.zeros(capacity, np.int64)
+        self.stats = np.zeros((capacity, len(ITEMS)), np.int64)
+        self.action_item = np.zeros(capacity, np.int64)
+        self.action_target = np.full(capacity, -1, np.int64)  # Target slot of the queued action, -1 for none
+        self.signs = np.array(SIGNS, np.int64)
+
+    def grow(self):
+        capacity = len(self.players)
+        self.players.extend([None] * capacity)
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+        self.health = np.concatenate((self.health, np.zeros(capacity, np.int64)))
+        self.lives = np.concatenate((self.lives, np.zeros(capacity, np.int64)))
+        self.stats = np.concatenate((self.stats, np.zeros((capacity, len(ITEMS)), np.int64)))
+        self.action_item = np.concatenate((self.action_item, np.zeros(capacity, np.int64)))
+        self.action_target = np.concatenate((self.action_target, np.full(capacity, -1, np.int64)))
+
+    def join(self, player_id, pPlayer):
+        super().join(player_id, pPlayer)
+        slot = self.slots.get(player_id)
+        if slot is None:
+            if not self.free:
+                self.grow()
+            slot = self.slots[player_id] = self.free.pop()
+        self.players[slot] = pPlayer
+        self.health[slot] = pPlayer.health
+        self.lives[slot] = pPlayer.lives
+        self.stats[slot] = array_stats(pPlayer)
+        self.action_target[slot] = -1
+
+    def leave(self, player_id, pPlayer):
+        if self.combatants.get(player_id) is not pPlayer:
+            return
+        del self.combatants[player_id]
+        slot = self.slots.pop(player_id)
+        self.players[slot] = None
+        self.action_target[slot] = -1
+        self.action_target[self.action_target == slot] = -1  # The slot may be reused before the next step
+        self.free.append(slot)
+
+    def refresh(self, player_id):
+        slot = self.slots.get(player_id)
+        if slot is not None:
+            self.stats[slot] = array_stats(self.players[slot])
+
+    def queue(self, player_id, item, target_id):
+        slot = self.slots.get(player_id)
+        target = self.slots.get(target_id)
+        if slot is None or target is None or self.lives[slot] <= 0 or self.lives[target] <= 0:
+            return False
+        if self.action_target[slot] >= 0:
+            self.totals["replaced"] += 1
+        self.action_item[slot] = item
+        self.action_target[slot] = target
+        self.totals["actions"] += 1
+        return True
+
+    def step(self):
+        start = time.perf_counter()
+        acting = np.flatnonzero(self.action_target >= 0)
+        if len(acting):
+            targets = self.action_target[acting]
+            items = self.action_item[acting]
+            np.add.at(self.health, targets, self.stats[acting, items] * self.signs[items])
+            self.action_target[acting] = -1
+            self.settle_slots(np.flatnonzero(np.bincount(targets, minlength=len(self.health))))
+        self.steps += 1
+        self.totals["step_time"] += time.perf_counter() - start
+
+    def settle_slots(self, hit):
+        # CombatSimulation.settle for all slots hit in a step, then copied back to their Players
+        health = self.health[hit]
+        lives = self.lives[hit]
+        dead = health <= 0
+        lives = np.where(dead, np.maximum(lives - 1, 0), lives)
+        health = np.where(dead, np.where(lives > 0, player.MAX_HEALTH, 0), np.minimum(health, player.MAX_HEALTH))
+        self.health[hit] = health
+        self.lives[hit] = lives
+        self.totals["deaths"] += int(dead.sum())
+
+        players = self.players
+        for slot, slot_health, slot_lives in zip(hit.tolist(), health.tolist(), lives.tolist()):
+            pPlayer = players[slot]
+            pPlayer.health = slot_health
+            pPlayer.lives = slot_lives
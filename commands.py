@@ -0,0 +1,94 @@
+# commands.py
+# Table of client commands: name -> handler, with the arguments each one expects
+
+import time
+
+
+class Command:
+    """
+    One registered command. schema lists a converter per field (e.g. int), the
+    last optional of which may be left out, and credentials marks commands that
+    need a username and password rather than a session token. Also keeps the
+    call count and timings of its handler.
+    """
+
+    def __init__(self, name, handler, schema=(), optional=0, credentials=False):
+        self.name = name
+        self.handler = handler
+        self.schema = schema
+        self.optional = optional
+        self.credentials = credentials
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def check(self, request):
+        """
+        Converts request.fields in place. Returns False if the request does not
+        match the schema.
+        """
+        if not len(self.schema) - self.optional <= len(request.fields) <= len(self.schema):
+            return False
+        if self.credentials and request.password is None:
+            return False
+        if not request.binary and self.schema:
+            # Binary fields are unpacked with their types already
+            try:
+                request.fields = tuple(convert(value) for convert, value in zip(self.schema, request.fields))
+            except ValueError:
+                return False
+        return True
+
+
+class CommandRegistry:
+    """
+    Maps command names to Commands, so dispatching is a single dict lookup no
+    matter how many commands exist. Timing hooks are called as
+    hook(command, elapsed_seconds) after every handled request.
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.timing_hooks = []
+
+    def register(self, name, schema=(), optional=0, credentials=False):
+        """
+        Decorator for handler functions: @registry.register("GET_STATS").
+        """
+        def decorator(handler):
+            if name in self.commands:
+                raise ValueError(f"Command {name} is already registered")
+            self.commands[name] = Command(name, handler, schema, optional, credentials)
+            return handler
+        return decorator
+
+    def add_timing_hook(self, hook):
+        self.timing_hooks.append(hook)
+
+    def get(self, name):
+        return self.commands.get(name)
+
+    def run(self, command, *args):
+        start = time.perf_counter()
+        try:
+            command.handler(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            command.calls += 1
+            command.total_time += elapsed
+            if elapsed > command.max_time:
+                command.max_time = elapsed
+            for hook in self.timing_hooks:
+                hook(command, elapsed)
+
+    def timing_report(self):
+        """
+        Returns one line per command that was called: calls, mean and max time.
+        """
+        lines = []
+        for command in sorted(self.commands.values(), key=lambda c: c.total_time, reverse=True):
+            if command.calls:
+                mean = command.total_time / command.calls * 1e6
+                lines.append(f"{command.name}: {command.calls} calls, "
+                             f"mean {mean:.1f}us, max {command.max_time * 1e6:.1f}us")
+        return lines
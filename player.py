@@ -1,36 +1,69 @@
-import json, os
+import json, os, sys
+from collections import namedtuple
 from enum import Enum
 import pygame
 
-class Sword:
-    def __init__(self, name, damage):
-        self.name = name
-        self.damage = damage
+MAX_HEALTH = 100  # Health a player starts a life with
+WORLD_SIZE = 2000  # Positions run from 0 to WORLD_SIZE - 1 on both axes
+
+
+class Item:
+    # Items are flyweights: a shared ItemTemplate plus this copy's stat. The
+    # catalog hands the same object to every player with the same item and stat,
+    # so they can't be changed once made; a player gets another item instead
+    # (see Player.init_stats).
+    __slots__ = ()
+
+    def __init__(self, template, stat_field, stat):
+        object.__setattr__(self, "template", template)
+        object.__setattr__(self, stat_field, stat)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} items are shared between players and can't be changed")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} items are shared between players and can't be changed")
+
+    @property
+    def name(self):
+        return self.template.name
+
+
+class Sword(Item):
+    __slots__ = ("template", "damage")
+
+    def __init__(self, template, damage):
+        super().__init__(template, "damage", damage)
 
     def use(self, target):
         if type(target) == Player:
             target.health -= self.damage
 
 
-class Shield:
-    def __init__(self, name, defense):
-        self.name = name
-        self.defense = defense
+class Shield(Item):
+    __slots__ = ("template", "defense")
+
+    def __init__(self, template, defense):
+        super().__init__(template, "defense", defense)
 
     def use(self, target):
         if type(target) == Player:
             target.health += self.defense
 
 
-class Potion:
+class Potion(Item):
     class Effect(Enum):
         SLAYING = "slaying"
         HEALING = "healing"
 
-    def __init__(self, name, effect, strength=-1):
-        self.name = name
-        self.effect = effect
-        self.strength = strength
+    __slots__ = ("template", "strength")
+
+    def __init__(self, template, strength=-1):
+        super().__init__(template, "strength", strength)
+
+    @property
+    def effect(self):
+        return self.template.effect
 
     def use(self, target):
         if type(target) == Player:
@@ -40,7 +73,89 @@ class Potion:
                 target.health += self.strength
 
 
+# What every copy of an item shares: catalog key, display name, kind (a key of
+# ITEM_CLASSES), potion effect (None for other kinds) and default stat
+ItemTemplate = namedtuple("ItemTemplate", "key name kind effect stat")
+ITEM_CLASSES = {"sword": Sword, "shield": Shield, "potion": Potion}
+ITEMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "items.json")
+
+
+class ItemCatalog:
+    """
+    The item templates from items.json, plus the item instances handed out so
+    far keyed by (template key, stat). Players with the same item and stat all
+    hold the same instance, so a new player or a stat change only allocates an
+    item the first time that combination shows up. New items only need an
+    entry in items.json.
+    """
+
+    MAX_SHARED = 4096  # Instances kept for sharing; past this, unusual stats get an item of their own
+
+    def __init__(self, templates, defaults):
+        self.templates = templates  # key -> ItemTemplate
+        self.by_name = {template.name: template for template in templates.values()}
+        self.defaults = defaults  # Inventory slot -> key of the template a new player gets
+        self.shared = {key: {} for key in templates}  # key -> stat -> item
+        self.num_shared = 0
+        self.default_items = {slot: self.item(key) for slot, key in defaults.items()}
+
+    @classmethod
+    def load(cls, filepath=ITEMS_FILE):
+        with open(filepath, 'r') as f:
+            data = json.load(f)
+        templates = {}
+        for key, entry in data["items"].items():
+            if entry["kind"] not in ITEM_CLASSES:
+                raise ValueError(f"Item {key} has unknown kind {entry['kind']}")
+            effect = Potion.Effect(entry["effect"]) if entry["kind"] == "potion" else None
+            templates[key] = ItemTemplate(sys.intern(key), sys.intern(entry["name"]), entry["kind"], effect,
+                                          entry.get("stat", -1))
+        for slot, key in data["defaults"].items():
+            if key not in templates:
+                raise ValueError(f"Default {slot} item {key} is not in the catalog")
+        return cls(templates, data["defaults"])
+
+    def item(self, key, stat=None):
+        """
+        Returns the item made from template key with stat, or the template's
+        default stat if None.
+        """
+        shared = self.shared[key]
+        item = shared.get(stat)
+        if item is None:
+            template = self.templates[key]
+            item = ITEM_CLASSES[template.kind](template, template.stat if stat is None else stat)
+            if self.num_shared < self.MAX_SHARED:
+                shared[stat] = item
+                self.num_shared += 1
+        return item
+
+    def default(self, slot):
+        return self.default_items[slot]
+
+    def fits(self, slot, template):
+        # An inventory slot takes items of the same kind and effect as its default
+        default = self.templates[self.defaults[slot]]
+        return template.kind == default.kind and template.effect == default.effect
+
+    def saved_item(self, slot, data, stat_field):
+        """
+        The item for an inventory slot saved by save_inventory: found by its
+        catalog key, else by name (saves from before the catalog), else the
+        slot's default.
+        """
+        template = self.templates.get(data.get("item")) or self.by_name.get(data.get("name"))
+        if template is None or not self.fits(slot, template):
+            template = self.templates[self.defaults[slot]]
+        return self.item(template.key, data.get(stat_field, template.stat))
+
+
+CATALOG = ItemCatalog.load()  # Loaded once, when the module is first imported
+
+
 class Profile:
+    __slots__ = ("username", "password", "avatar")
+
     def __init__(self, username, password):
         self.username = username
         self.password = password
@@ -55,18 +170,26 @@ class Profile:
 
 
 class Inventory:
+    __slots__ = ("sword", "shield", "slaying_potion", "healing_potion")
+
     def __init__(self):
-        self.sword = Sword("Basic Sword", -1)
-        self.shield = Shield("Basic Shield", -1)
-        self.slaying_potion = Potion("Slaying Potion", Potion.Effect.SLAYING, -1)
-        self.healing_potion = Potion("Healing Potion", Potion.Effect.HEALING, -1)
+        # The catalog's shared default items, nothing is allocated per player
+        self.sword = CATALOG.default("sword")
+        self.shield = CATALOG.default("shield")
+        self.slaying_potion = CATALOG.default("slaying_potion")
+        self.healing_potion = CATALOG.default("healing_potion")
 
 
 class Player:
+    __slots__ = ("profile", "inventory", "lives", "health", "x", "y")
+
     def __init__(self):
         self.profile = None
         self.inventory = Inventory()
         self.lives = 2
+        self.health = MAX_HEALTH  # Changed by the items used on this player, see combat.py
+        self.x = 0  # Position in the world, set by the server (spawn point, then MOVE)
+        self.y = 0
 
     def create_profile(self, username, password):
         self.profile = Profile(username, password)
@@ -94,6 +217,7 @@ class Player:
 
 
     def load_inventory(self, filepath):
+        # Returns the version saved with the inventory, if any
         if not os.path.exists(filepath):
             raise FileNotFoundError("Inventory file not found.")
         with open(filepath, 'r') as f:
@@ -103,43 +227,48 @@ class Player:
         slaying_potion_data = data.get("slaying_potion", {})
         healing_potion_data = data.get("healing_potion", {})
 
-        self.inventory.sword = Sword(sword_data.get("name", "Basic Sword"), sword_data.get("damage", -1))
-        self.inventory.shield = Shield(shield_data.get("name", "Basic Shield"), shield_data.get("defense", -1))
-        self.inventory.slaying_potion = Potion(slaying_potion_data.get("name", "Slaying Potion"),
-                                               Potion.Effect.SLAYING,
-                                               slaying_potion_data.get("strength", -1))
-        self.inventory.healing_potion = Potion(healing_potion_data.get("name", "Healing Potion"),
-                                               Potion.Effect.HEALING,
-                                               healing_potion_data.get("strength", -1))
+        self.inventory.sword = CATALOG.saved_item("sword", sword_data, "damage")
+        self.inventory.shield = CATALOG.saved_item("shield", shield_data, "defense")
+        self.inventory.slaying_potion = CATALOG.saved_item("slaying_potion", slaying_potion_data, "strength")
+        self.inventory.healing_potion = CATALOG.saved_item("healing_potion", healing_potion_data, "strength")
+        return data.get("version")
 
-    def save_inventory(self, filepath):
+    def save_inventory(self, filepath, version=None):
         data = {
             "sword": {
+                "item": self.inventory.sword.template.key,
                 "name": self.inventory.sword.name,
                 "damage": self.inventory.sword.damage
             },
             "shield": {
+                "item": self.inventory.shield.template.key,
                 "name": self.inventory.shield.name,
                 "defense": self.inventory.shield.defense
             },
             "slaying_potion": {
+                "item": self.inventory.slaying_potion.template.key,
                 "name": self.inventory.slaying_potion.name,
                 "strength": self.inventory.slaying_potion.strength
             },
             "healing_potion": {
+                "item": self.inventory.healing_potion.template.key,
                 "name": self.inventory.healing_potion.name,
                 "strength": self.inventory.healing_potion.strength
             }
         }
+        if version is not None:
+            data["version"] = version  # Server's stats version, when saved as a client-side cache
         with open(filepath, 'w') as f:
             json.dump(data, f)
 
 
     def init_stats(self, sword_damage, shield_defense, slaying_strength, healing_strength):
-        self.inventory.sword.damage = sword_damage
-        self.inventory.shield.defense = shield_defense
-        self.inventory.slaying_potion.strength = slaying_strength
-        self.inventory.healing_potion.strength = healing_strength
+        # Items are shared, so new stats swap in the catalog's items with those stats
+        inventory = self.inventory
+        inventory.sword = CATALOG.item(inventory.sword.template.key, sword_damage)
+        inventory.shield = CATALOG.item(inventory.shield.template.key, shield_defense)
+        inventory.slaying_potion = CATALOG.item(inventory.slaying_potion.template.key, slaying_strength)
+        inventory.healing_potion = CATALOG.item(inventory.healing_potion.template.key, healing_strength)
 
 
 def hash_password(password):
@@ -0,0 +1,346 @@
+# protocol.py
+# Wire formats shared by client.py and server.py: the original text commands and
+# a compact binary framing that a client can switch to once LOGIN negotiated it.
+
+import struct
+from sync import STATE_FIELDS
+
+MAGIC = 0xB7  # First byte of every binary packet, never the start of a text command
+VERSION = 4
+BINARY_TAG = f"BIN/{VERSION}"  # Appended to LOGIN (client) and LOGIN_SUCCESS (server) to negotiate binary
+HEARTBEAT_TAG = "HB/"  # LOGIN_SUCCESS tag with the heartbeat interval the server wants, e.g. HB/5
+
+# Reply names are the command name plus one of these
+REPLY_SUFFIXES = ("_SUCCESS", "_NOT_MODIFIED", "_FAIL", "_COUNT")
+
+# Text envelope for several commands in one datagram: "BATCH\n<command>\n<command>..."
+# The reply uses the same envelope, with one line per reply in command order.
+BATCH_HEADER = "BATCH"
+MAX_BATCH = 16  # Commands past this are dropped, keeping replies well inside one datagram
+
+# magic, version, opcode, request id (echoed back in the reply)
+HEADER = struct.Struct("!BBBH")
+TOKEN_SIZE = 8  # Session tokens are 16 hex chars as text, 8 raw bytes here
+
+# Binary requests, all sent with a session token after LOGIN
+REQUEST_OPCODES = {
+    "LOGINS": 3,
+    "SET_STATS": 4,
+    "GET_STATS": 5,
+    "HEARTBEAT": 6,
+    "STATE_ACK": 7,
+    "USE_ITEM": 8,
+    "MOVE": 9,
+    "NEARBY_ACK": 10,
+}
+REQUEST_PAYLOADS = {
+    3: struct.Struct("!8s"),
+    4: struct.Struct("!8s4i"),  # sword damage, shield defense, slaying strength, healing strength
+    5: struct.Struct("!8sI"),  # stats version the client has cached, 0 for none
+    6: struct.Struct("!8s"),
+    7: struct.Struct("!8sI"),  # seq of the state push being acked
+    8: struct.Struct("!8sBI"),  # item (index into combat.ITEMS), target player id, 0 for the sender
+    9: struct.Struct("!8sii"),  # x and y step
+    10: struct.Struct("!8sI"),  # seq of the nearby players push being acked
+}
+REQUEST_NAMES = {opcode: name for name, opcode in REQUEST_OPCODES.items()}
+
+# Binary replies. *_FAIL replies carry an index into FAIL_REASONS.
+RESPONSE_OPCODES = {
+    "LOGINS_COUNT": 0x83,
+    "LOGINS_FAIL": 0xC3,
+    "SET_STATS_SUCCESS": 0x84,
+    "SET_STATS_FAIL": 0xC4,
+    "GET_STATS_SUCCESS": 0x85,
+    "GET_STATS_NOT_MODIFIED": 0xA5,
+    "GET_STATS_FAIL": 0xC5,
+    "USE_ITEM_SUCCESS": 0x88,
+    "USE_ITEM_FAIL": 0xC8,
+}
+RESPONSE_PAYLOADS = {
+    0x83: struct.Struct("!I"),
+    0xC3: struct.Struct("!B"),
+    0x84: struct.Struct(""),
+    0xC4: struct.Struct("!B"),
+    0x85: struct.Struct("!4iI"),  # four stats, then their version
+    0xA5: struct.Struct("!I"),
+    0xC5: struct.Struct("!B"),
+    0x88: struct.Struct(""),
+    0xC8: struct.Struct("!B"),
+}
+RESPONSE_NAMES = {opcode: name for name, opcode in RESPONSE_OPCODES.items()}
+FAIL_REASONS = ["Invalid credentials", "No stats found", "Invalid stats", "Invalid action"]
+INT_RANGE = range(-(1 << 31), 1 << 31)  # Values a binary int field ("i") holds; text ones are checked against it
+
+
+def fits_int(*values):
+    return all(value in INT_RANGE for value in values)
+
+
+def clamp_int(value):
+    return min(max(value, INT_RANGE.start), INT_RANGE.stop - 1)
+
+# Server-pushed player state (sync.py). Binary: seq, base seq (0 for a full
+# snapshot), a bitmask of the fields that follow, then one int per field.
+# Text: 'STATE <seq> <base_seq> sword_damage=5 lives=1'.
+STATE_OPCODE = 0x90
+STATE_HEADER = struct.Struct("!IIB")  # A one byte mask, so at most 8 STATE_FIELDS
+STATE_VALUE = struct.Struct("!i")
+
+# Server-wide announcements: 'ANNOUNCE <text>', or the header followed by UTF-8 text
+ANNOUNCE_OPCODE = 0x91
+
+# The other players in the receiver's area of interest (server.py push_nearby), acked with
+# NEARBY_ACK: 'NEARBY <seq> <id>,<x>,<y>,<health> ...', or the header, seq, a count and that many entries
+NEARBY_OPCODE = 0x92
+NEARBY_HEADER = struct.Struct("!IH")
+NEARBY_ENTRY = struct.Struct("!Iiii")  # player id, x, y, health
+MAX_NEARBY = 64  # Only the closest players past this, so the push stays one small datagram
+
+
+class Request:
+    """
+    One client command, decoded from either wire format. Handlers only ever
+    see this, never the raw packet.
+    """
+
+    def __init__(self, command, fields=(), username=None, password=None, token=None,
+                 binary=False, request_id=0, extra=()):
+        self.command = command
+        self.fields = fields  # Command arguments, already converted (e.g. SET_STATS ints)
+        self.username = username
+        self.password = password
+        self.token = token  # Hex session token, when sent instead of username + password
+        self.binary = binary  # Reply in the same format the request came in
+        self.request_id = request_id
+        self.extra = extra  # Trailing text fields, e.g. the BIN/1 tag on LOGIN
+        self.session = None  # Filled in by the server when the token resolves
+
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def heartbeat_token(data):
+    """
+    Returns the session token of a heartbeat, text or binary, without a full
+    parse. None for any other packet, including heartbeats without a token.
+    data may be a str or the raw datagram (bytes or a memoryview).
+    """
+    if isinstance(data, str):
+        if not data.startswith("HEARTBEAT "):
+            return None
+        token = data[len("HEARTBEAT "):].strip()
+        return token if token and " " not in token else None
+    if not data:
+        return None
+    first = data[0]
+    if first == MAGIC:
+        if len(data) == HEADER.size + TOKEN_SIZE and data[1] == VERSION and data[2] == REQUEST_OPCODES["HEARTBEAT"]:
+            return data[HEADER.size:].hex()
+    elif first == ord("H"):
+        # Of the text commands only HEARTBEAT starts with H, nothing else is decoded here
+        return heartbeat_token(str(data, "utf-8", "replace"))
+    return None
+
+
+def parse_text_request(data):
+    """
+    Parses 'COMMAND user pass [extra...]' or 'COMMAND <token>'. Arguments
+    follow the command name: 'SET_STATS:1,2,3,4 ...'. They are left as strings
+    for the command's schema to convert. Returns a Request, or None if the
+    command is malformed.
+    """
+    parts = data.split()
+    if len(parts) < 2:
+        return None
+
+    command, _, arguments = parts[0].partition(":")
+    fields = tuple(arguments.split(",")) if arguments else ()
+
+    if len(parts) == 2:
+        return Request(command, fields, token=parts[1])
+    return Request(command, fields, username=parts[1], password=parts[2], extra=tuple(parts[3:]))
+
+
+def decode_request(data):
+    """
+    Decodes a binary request packet (bytes or a memoryview) into a Request, or
+    None if it is malformed. Nothing is copied but the token.
+    """
+    if len(data) < HEADER.size:
+        return None
+    magic, version, opcode, request_id = HEADER.unpack_from(data)
+    payload = REQUEST_PAYLOADS.get(opcode)
+    if magic != MAGIC or version != VERSION or payload is None or len(data) != HEADER.size + payload.size:
+        return None
+    token, *fields = payload.unpack_from(data, HEADER.size)
+    return Request(REQUEST_NAMES[opcode], tuple(fields), token=token.hex(), binary=True, request_id=request_id)
+
+
+def encode_request(command, token, fields=(), request_id=0):
+    opcode = REQUEST_OPCODES[command]
+    return HEADER.pack(MAGIC, VERSION, opcode, request_id) + \
+        REQUEST_PAYLOADS[opcode].pack(bytes.fromhex(token), *fields)
+
+
+def encode_response(name, fields=(), request_id=0):
+    opcode = RESPONSE_OPCODES[name]
+    if name.endswith("_FAIL"):
+        fields = (FAIL_REASONS.index(fields[0]),)
+    return HEADER.pack(MAGIC, VERSION, opcode, request_id) + RESPONSE_PAYLOADS[opcode].pack(*fields)
+
+
+def decode_response(data):
+    """
+    Returns (name, fields, request_id) for a binary reply.
+    """
+    magic, version, opcode, request_id = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or opcode not in RESPONSE_PAYLOADS:
+        raise ValueError(f"Unknown binary response (version {version}, opcode {opcode})")
+    fields = RESPONSE_PAYLOADS[opcode].unpack_from(data, HEADER.size)
+    name = RESPONSE_NAMES[opcode]
+    if name.endswith("_FAIL"):
+        fields = (FAIL_REASONS[fields[0]],)
+    return name, fields, request_id
+
+
+def format_text_response(name, fields=()):
+    """
+    Builds the text form of a reply, e.g. 'GET_STATS_SUCCESS 1,2,3,4'.
+    """
+    if not fields:
+        return name
+    if name == "GET_STATS_SUCCESS":
+        # The four stats comma-separated, then their version: 'GET_STATS_SUCCESS 1,2,3,4 7'
+        return f"{name} {','.join(str(value) for value in fields[:4])} {fields[4]}"
+    return f"{name} {' '.join(str(value) for value in fields)}"
+
+
+def is_batch(data):
+    return data.startswith(BATCH_HEADER + "\n")
+
+
+def join_batch(messages):
+    return "\n".join((BATCH_HEADER, *messages))
+
+
+def split_batch(data):
+    return [line for line in data.split("\n")[1:] if line]
+
+
+def reply_command(reply):
+    """
+    Returns the command a text reply answers, e.g. 'LOGINS' for 'LOGINS_COUNT 3'.
+    """
+    name = reply.split(" ", 1)[0]
+    for suffix in REPLY_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def is_push(data):
+    # Packets the server sends without being asked: state pushes, nearby players and announcements
+    return is_state(data) or is_nearby(data) or is_announcement(data)
+
+
+def is_state(data):
+    if is_binary(data):
+        return len(data) >= HEADER.size and data[2] == STATE_OPCODE
+    return data[:len(b"STATE ")] == b"STATE "
+
+
+def encode_state(seq, base_seq, changes, binary):
+    """
+    Builds a state push. changes maps indexes into STATE_FIELDS to values.
+    """
+    if not binary:
+        fields = " ".join(f"{STATE_FIELDS[i]}={value}" for i, value in sorted(changes.items()))
+        return f"STATE {seq} {base_seq} {fields}".rstrip().encode()
+    mask = 0
+    for i in changes:
+        mask |= 1 << i
+    return HEADER.pack(MAGIC, VERSION, STATE_OPCODE, 0) + STATE_HEADER.pack(seq, base_seq, mask) + \
+        b"".join(STATE_VALUE.pack(value) for _, value in sorted(changes.items()))
+
+
+def decode_state(data):
+    """
+    Returns (seq, base_seq, changes) for a state push, raising ValueError if it is malformed.
+    """
+    try:
+        if not is_binary(data):
+            _, seq, base_seq, *fields = str(data, "utf-8").split()
+            changes = {}
+            for field in fields:
+                name, _, value = field.partition("=")
+                changes[STATE_FIELDS.index(name)] = int(value)
+            return int(seq), int(base_seq), changes
+
+        seq, base_seq, mask = STATE_HEADER.unpack_from(data, HEADER.size)
+        indexes = [i for i in range(len(STATE_FIELDS)) if mask & (1 << i)]
+        offset = HEADER.size + STATE_HEADER.size
+        if len(data) != offset + STATE_VALUE.size * len(indexes):
+            raise ValueError("State push length does not match its field mask")
+        values = [STATE_VALUE.unpack_from(data, offset + STATE_VALUE.size * n)[0] for n in range(len(indexes))]
+        return seq, base_seq, dict(zip(indexes, values))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed state push: {e}")
+
+
+def is_nearby(data):
+    if is_binary(data):
+        return len(data) >= HEADER.size and data[2] == NEARBY_OPCODE
+    return data[:len(b"NEARBY")] == b"NEARBY"
+
+
+def encode_nearby(seq, entries, binary):
+    """
+    Builds a nearby players push from (player_id, x, y, health) entries.
+    """
+    if not binary:
+        return " ".join(["NEARBY", str(seq),
+                         *(f"{player_id},{x},{y},{health}" for player_id, x, y, health in entries)]).encode()
+    return HEADER.pack(MAGIC, VERSION, NEARBY_OPCODE, 0) + NEARBY_HEADER.pack(seq, len(entries)) + \
+        b"".join(NEARBY_ENTRY.pack(int(player_id), x, y, health) for player_id, x, y, health in entries)
+
+
+def decode_nearby(data):
+    """
+    Returns (seq, entries) for a nearby players push, entries being (player_id,
+    x, y, health) ints, raising ValueError if it is malformed.
+    """
+    try:
+        if not is_binary(data):
+            _, seq, *fields = str(data, "utf-8").split()
+            entries = [tuple(int(value) for value in field.split(",")) for field in fields]
+            if any(len(entry) != 4 for entry in entries):
+                raise ValueError("Nearby entries need an id, x, y and health")
+            return int(seq), entries
+
+        seq, count = NEARBY_HEADER.unpack_from(data, HEADER.size)
+        offset = HEADER.size + NEARBY_HEADER.size
+        if len(data) != offset + NEARBY_ENTRY.size * count:
+            raise ValueError("Nearby push length does not match its count")
+        return seq, [NEARBY_ENTRY.unpack_from(data, offset + NEARBY_ENTRY.size * n) for n in range(count)]
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed nearby push: {e}")
+
+
+def is_announcement(data):
+    if is_binary(data):
+        return len(data) >= HEADER.size and data[2] == ANNOUNCE_OPCODE
+    return data[:len(b"ANNOUNCE ")] == b"ANNOUNCE "
+
+
+def encode_announcement(message, binary):
+    if binary:
+        return HEADER.pack(MAGIC, VERSION, ANNOUNCE_OPCODE, 0) + message.encode()
+    return f"ANNOUNCE {message}".encode()
+
+
+def decode_announcement(data):
+    if is_binary(data):
+        return str(data[HEADER.size:], "utf-8", "replace")
+    return str(data[len(b"ANNOUNCE "):], "utf-8", "replace")
@@ -0,0 +1,155 @@
+# reliable.py
+# Optional reliability envelope around client datagrams: sequence numbers, acks,
+# retransmits with an adaptive timeout, and duplicate suppression.
+
+import struct
+from collections import OrderedDict
+
+MAGIC = 0xB8  # First byte of a reliable packet, distinct from text and protocol.MAGIC
+FLAG_DATA = 0x01  # Carries a payload
+FLAG_ACK = 0x02  # Acknowledges seq. A reply has both flags, a bare ack only this one
+
+# magic, flags, sequence number. The payload (a text command, binary packet or reply) follows.
+HEADER = struct.Struct("!BBI")
+
+
+def is_reliable(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def wrap(flags, seq, payload=b""):
+    return HEADER.pack(MAGIC, flags, seq) + payload
+
+
+def unwrap(data):
+    """
+    Returns (flags, seq, payload), or None if data is not a reliable packet.
+    """
+    if len(data) < HEADER.size or data[0] != MAGIC:
+        return None
+    _, flags, seq = HEADER.unpack_from(data)
+    return flags, seq, data[HEADER.size:]
+
+
+class RttEstimator:
+    """
+    Retransmit timeout from measured round trips, as in RFC 6298: a smoothed
+    RTT plus four times its variance, doubled on every timeout.
+    """
+
+    INITIAL_RTO = 1.0
+    MIN_RTO = 0.2
+    MAX_RTO = 4.0
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.INITIAL_RTO
+
+    def update(self, rtt):
+        # Only call with samples from messages that were not retransmitted (Karn's rule)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.MAX_RTO)
+        return self.rto
+
+
+class ReceiveWindow:
+    """
+    Sliding window over the last SIZE sequence numbers seen from one peer. A
+    number is accepted once; anything older than the window counts as a
+    duplicate, unless it is so much older that the peer must have started
+    over (a restarted client picks a new random first number, and numbers
+    wrap at 2**32), which starts a fresh window.
+    """
+
+    SIZE = 64
+    RESTART_GAP = 1 << 16  # Further below the highest number than any retransmit could be
+
+    def __init__(self):
+        self.highest = None
+        self.mask = 0  # Bit i set: highest - i was seen
+
+    def accept(self, seq):
+        if self.highest is not None and self.highest - seq >= self.RESTART_GAP:
+            self.highest = None
+            self.mask = 0
+        if self.highest is None or seq > self.highest:
+            shift = self.SIZE if self.highest is None else seq - self.highest
+            self.mask = ((self.mask << shift) | 1) & ((1 << self.SIZE) - 1)
+            self.highest = seq
+            return True
+        bit = 1 << (self.highest - seq)
+        if self.highest - seq >= self.SIZE or self.mask & bit:
+            return False
+        self.mask |= bit
+        return True
+
+
+class DuplicateFilter:
+    """
+    One ReceiveWindow per client address, least recently used ones dropped
+    past max_peers.
+    """
+
+    def __init__(self, max_peers=4096):
+        self.max_peers = max_peers
+        self.windows = OrderedDict()
+
+    def accept(self, address, seq):
+        window = self.windows.get(address)
+        if window is None:
+            window = self.windows[address] = ReceiveWindow()
+            if len(self.windows) > self.max_peers:
+                self.windows.popitem(last=False)
+        else:
+            self.windows.move_to_end(address)
+        return window.accept(seq)
+
+    def forget(self, address):
+        self.windows.pop(address, None)
+
+
+class ResponseCache:
+    """
+    Recent replies per client address, keyed by sequence number, so a
+    retransmitted request is answered from memory instead of running its
+    handler again. Each address keeps at most max_entries replies no older
+    than max_age seconds; least recently used addresses are dropped past
+    max_peers.
+    """
+
+    def __init__(self, max_entries=32, max_age=30.0, max_peers=4096):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_peers = max_peers
+        self.peers = OrderedDict()  # address -> OrderedDict of seq -> (sent_at, packet), oldest first
+
+    def put(self, address, seq, packet, now):
+        replies = self.peers.get(address)
+        if replies is None:
+            replies = self.peers[address] = OrderedDict()
+            if len(self.peers) > self.max_peers:
+                self.peers.popitem(last=False)
+        else:
+            self.peers.move_to_end(address)
+        replies[seq] = (now, packet)
+        while len(replies) > self.max_entries or next(iter(replies.values()))[0] < now - self.max_age:
+            replies.popitem(last=False)
+
+    def get(self, address, seq, now):
+        replies = self.peers.get(address)
+        entry = replies.get(seq) if replies is not None else None
+        if entry is None or entry[0] < now - self.max_age:
+            return None
+        return entry[1]
+
+    def forget(self, address):
+        self.peers.pop(address, None)
@@ -0,0 +1,30 @@
+# ring.py
+# Preallocated receive buffers for the UDP sockets
+
+
+class ReceiveRing:
+    """
+    A fixed set of receive buffers in one preallocated bytearray, used round
+    robin. recv() reads the next datagram straight into the next slot with
+    recvfrom_into and returns a memoryview of it, so no bytes object is
+    allocated or copied per packet.
+
+    A view stays valid until the ring comes back round to its slot, slots
+    datagrams later. Anything kept beyond handling the packet must be copied.
+    """
+
+    def __init__(self, slots=32, slot_size=4096):
+        self.buffer = bytearray(slots * slot_size)
+        whole = memoryview(self.buffer)
+        self.views = [whole[i * slot_size:(i + 1) * slot_size] for i in range(slots)]
+        self.next_slot = 0
+
+    def recv(self, sock):
+        """
+        Receives one datagram from sock. Returns (view, address), with the same
+        exceptions as sock.recvfrom.
+        """
+        view = self.views[self.next_slot]
+        nbytes, address = sock.recvfrom_into(view)
+        self.next_slot = (self.next_slot + 1) % len(self.views)
+        return view[:nbytes], address
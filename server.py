@@ -1,27 +1,87 @@
-import pygame, json, os, player
-import socket, time
+import pygame, player
+import socket, time, argparse, secrets, asyncio, os, multiprocessing, sys, types, random
+from enum import Enum
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from logger import ServerLogger
+from timeouts import ExpiryQueue
+from commands import CommandRegistry
+from broadcast import Broadcaster
+from ring import ReceiveRing
+from spatial import SpatialGrid
+from combat import CombatSimulation, ArrayCombatSimulation, ITEMS, HAVE_NUMPY
+import protocol, reliable, sync
+from storage import JsonFileStorage, LazyJsonStorage, SqliteStorage, ShardedStorage
+
+
+class Session:
+    """
+    One active player, the value active_players holds per client address.
+    Slotted, as there is one per connected client.
+    """
+
+    __slots__ = ("player", "player_id", "token", "last_ping", "binary", "sync", "nearby", "nearby_seq",
+                 "nearby_acked", "nearby_ticks")
+
+    def __init__(self, pPlayer, player_id, token, binary):
+        self.player = pPlayer
+        self.player_id = player_id
+        self.token = token
+        self.last_ping = time.monotonic()
+        self.binary = binary  # Whether the client negotiated the binary protocol at LOGIN
+        self.sync = sync.StateSync()  # State pushed to the client and what it acked
+        self.nearby = None  # Entries of the last nearby players push, see Server.push_nearby
+        self.nearby_seq = 0  # Its seq
+        self.nearby_acked = False  # Whether the client acked it
+        self.nearby_ticks = 0  # Ticks since it was sent
 
 
 class Server:
     # --- Server class ---
-    def __init__(self, host='localhost', port=9999):
+    def __init__(self, host='localhost', port=9999, storage=None, reuse_port=False, combat=None):
         # The Server class now creates and owns the logger instance
         self.sl = ServerLogger()
 
         self.server_address = (host, port)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            # Several worker processes bind the same port, the kernel spreads clients over them
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.settimeout(1.0)  # 1 second timeout for recvfrom
         self.sock.bind(self.server_address)
-        self.players = {}  # This is the persistent DB
+        self.transport = None  # Set when the asyncio server owns the socket
+        self.receive_ring = ReceiveRing()  # Preallocated buffers receive_data reads datagrams into
+        self.batch_replies = None  # Collects replies while a BATCH datagram is being handled
+        self.reply_seq = None  # Sequence number replies are acked with while a reliable packet is handled
+        self.replied = False
+        self.duplicates = reliable.DuplicateFilter()  # Reliable sequence numbers already handled, per address
+        self.responses = reliable.ResponseCache()  # Replies to recent reliable packets, resent for retransmits
         self.active_players = {}  # This stores in-memory player objects
-        self.server_db_path = "server_db.json"
+        self.sessions = {}  # session token -> client address in active_players
+        self.client_timeout = 15  # Seconds without an authenticated packet before a client is dropped
+        self.max_players = None  # Set from run_server_loop's maxPlayers, None means no limit
+        self.timeouts = ExpiryQueue()  # Client addresses keyed on last_ping + client_timeout
+        self.tick_interval = 0.1  # Seconds between server ticks: state pushes and broadcasts
+        self.last_tick = time.monotonic()
+        self.broadcaster = Broadcaster()  # Messages to many players, sent out on the next tick
+        # Active players' positions by client address, for finding who is near whom
+        self.aoi_radius = 150  # Players within this distance are in each other's area of interest
+        self.grid = SpatialGrid(cell_size=self.aoi_radius)
+        self.max_step = 10  # Furthest a MOVE goes on each axis
+        self.nearby_resend_every = 5  # Ticks to wait for a nearby push's ack before sending it again
+        self.nearby_totals = {"pushes": 0, "bytes": 0}
+        # Item uses of active players, resolved on its own fixed timestep
+        self.combat = combat if combat is not None else CombatSimulation()
+        # The persistent DB, server_db.json unless another backend is passed in
+        self.storage = storage if storage is not None else JsonFileStorage()
+        self.storage.sl = self.sl  # Storage backends log through the server's logger
         self.sl.info(f"Server started at {host}:{port}")  # Use self.sl
+        self.sl.info(f"Item catalog loaded ({len(player.CATALOG.templates)} items).")
 
     def receive_data(self):
+        # Returns a memoryview into receive_ring, only valid while the packet is being handled
         try:
-            data, client_address = self.sock.recvfrom(4096)
-            return data.decode(), client_address
+            return self.receive_ring.recv(self.sock)
         except socket.timeout:
             return "TIMEOUT", None
         except Exception as e:
@@ -29,216 +89,614 @@ class Server:
             return None, None
 
     def send_data(self, data, client_address):
+        if self.batch_replies is not None:
+            self.batch_replies.append(data)  # Sent together once the whole batch has run
+            return
+        self.send_bytes(data.encode(), client_address)
+
+    def reply(self, request, client_address, name, *fields):
+        """
+        Answers request in the format it came in, binary or text.
+        """
+        if request.binary:
+            self.send_bytes(protocol.encode_response(name, fields, request.request_id), client_address)
+        else:
+            self.send_data(protocol.format_text_response(name, fields), client_address)
+
+    def send_bytes(self, message, client_address):
+        if self.reply_seq is not None:
+            # The reply doubles as the ack for the client's reliable packet
+            message = reliable.wrap(reliable.FLAG_DATA | reliable.FLAG_ACK, self.reply_seq, message)
+            self.responses.put(client_address, self.reply_seq, message, time.monotonic())
+            self.replied = True
         try:
-            message = data.encode()
-            self.sock.sendto(message, client_address)
+            if self.transport is not None:
+                self.transport.sendto(message, client_address)
+            else:
+                self.sock.sendto(message, client_address)
         except Exception as e:
             self.sl.error(f"Error sending data: {e}")  # Use self.sl
 
     def load_db(self):
         try:
-            if os.path.exists(self.server_db_path):
-                with open(self.server_db_path, 'r') as f:
-                    self.players = json.load(f)
-                self.sl.info("Server database loaded.")  # Use self.sl
-            else:
-                self.sl.warning("No existing server database found. Starting fresh.")  # Use self.sl
+            self.storage.load()
+            self.sl.info(f"Server database loaded ({self.storage.count_players()} players).")  # Use self.sl
         except Exception as e:
             self.sl.error(f"Error loading server database: {e}")  # Use self.sl
-            self.players = {}
+
+    def flush_db(self):
+        self.storage.flush()
+
+    def maybe_flush(self):
+        self.storage.maybe_flush()
 
     def add_player_to_db(self, player_id, Player):
-        self.players[player_id] = {
+        self.storage.add_player(player_id, {
             "username": Player.profile.username,
             "password": Player.profile.password,
             "logins": 0
-        }
-        with open(self.server_db_path, 'w') as f:
-            json.dump(self.players, f, indent=4)  # Added indent for readability
+        })
 
     def set_player_stats_in_db(self, player_id, stats):
         # stat_type = ["sword_level", "shield_level", "slaying_potion_level", "healing_potion_level"]
-        if player_id in self.players:
-            self.players[player_id]["stats"] = stats
-            with open(self.server_db_path, 'w') as f:
-                json.dump(self.players, f, indent=4)  # Save updated DB
+        # Every change gets the next version, so clients can tell if their cached copy is current
+        old_stats = self.get_player_stats_in_db(player_id)
+        version = old_stats.get("version", 0) + 1 if old_stats else 1
+        self.storage.update_player(player_id, {"stats": dict(stats, version=version)})
 
     def get_player_stats_in_db(self, player_id):
-        if player_id in self.players and "stats" in self.players[player_id]:
-            return self.players[player_id]["stats"]
+        record = self.storage.get_player(player_id)
+        if record is not None and "stats" in record:
+            return record["stats"]
         return None
 
+    def rename_player_in_db(self, player_id, new_username):
+        if self.storage.get_player(player_id) is None or self.check_username_exists(new_username):
+            return False
+        self.storage.update_player(player_id, {"username": new_username})
+        return True
+
+    def remove_player_from_db(self, player_id):
+        if self.storage.get_player(player_id) is None:
+            return False
+        self.storage.remove_player(player_id)
+        return True
+
     def check_db(self, username, password):
-        for pid, pdata in self.players.items():
-            if pdata["username"] == username and pdata["password"] == password:
-                return pid
+        # O(1) lookup through the storage's username index instead of scanning every account
+        player_id = self.storage.find_player_id(username)
+        if player_id is not None and self.storage.get_player(player_id)["password"] == password:
+            return player_id
         return None
 
+    def increment_logins(self, player_id):
+        self.storage.increment_logins(player_id)
+
     def get_num_of_logins(self, player_id):
-        if player_id in self.players:
-            return self.players[player_id]["logins"]
+        record = self.storage.get_player(player_id)
+        if record is not None:
+            return record["logins"]
         return 0
 
     def check_username_exists(self, username):
-        for pid, pdata in self.players.items():
-            if pdata["username"] == username:
-                return True
-        return False
+        return self.storage.find_player_id(username) is not None
 
     def close(self):
         self.sock.close()
+        self.storage.close()
 
     def check_for_timeouts(self):
         """
         Checks for timed-out clients and removes them from active players.
+        Cheap enough to call on every loop iteration: when nobody is due this is
+        a single heap peek.
         """
-        TIMEOUT_DURATION = 15
-        inactive_clients = []
+        now = time.monotonic()
+        for address in self.timeouts.pop_expired(now, self.client_deadline):
+            self.sl.warning(f"Client {address} has timed out and will be removed.")
+            self.end_session(address)
 
-        for address, data in self.active_players.items():
-            time_since_last_ping = time.time() - data['last_ping']
-            if time_since_last_ping > TIMEOUT_DURATION:
-                inactive_clients.append(address)
+    def heartbeat_interval(self):
+        # Quiet time after which clients send a heartbeat, leaving room for two to get lost
+        return self.client_timeout / 3
 
-        for address in inactive_clients:
-            self.sl.warning(f"Client {address} has timed out and will be removed.")
-            del self.active_players[address]
+    def client_deadline(self, client_address):
+        data = self.active_players.get(client_address)
+        if data is None:
+            return None
+        return data.last_ping + self.client_timeout
 
+    def start_session(self, client_address, player_id, new_player, binary=False):
+        """
+        Makes the player active at client_address and returns their session token.
+        binary is whether the client negotiated the binary protocol at LOGIN.
+        """
+        self.end_session(client_address, forget_peer=False)  # The LOGIN being handled is in its duplicate window
+        token = secrets.token_hex(8)
+        self.active_players[client_address] = Session(new_player, player_id, token, binary)
+        self.sessions[token] = client_address
+        self.grid.insert(client_address, new_player.x, new_player.y)
+        self.combat.join(player_id, new_player)
+        self.timeouts.add(client_address, self.client_deadline(client_address))
+        return token
+
+    def get_session(self, token, client_address):
+        # A token is only valid from the address that logged in with it
+        if self.sessions.get(token) != client_address:
+            return None
+        return self.active_players[client_address]
+
+    def push_state(self):
+        """
+        Sends every active player the changes to their state since the last
+        state they acked, plus the periodic full snapshots.
+        """
+        for client_address, data in self.active_players.items():
+            update = data.sync.update(sync.player_state(data.player))
+            if update is not None:
+                self.send_bytes(protocol.encode_state(*update, data.binary), client_address)
+
+    def spawn_point(self):
+        return random.randrange(player.WORLD_SIZE), random.randrange(player.WORLD_SIZE)
+
+    def move_player(self, client_address, dx, dy):
+        # Steps are clamped to max_step on each axis and the player stays inside the world
+        pPlayer = self.active_players[client_address].player
+        edge = player.WORLD_SIZE - 1
+        pPlayer.x = clamp(pPlayer.x + clamp(dx, -self.max_step, self.max_step), 0, edge)
+        pPlayer.y = clamp(pPlayer.y + clamp(dy, -self.max_step, self.max_step), 0, edge)
+        self.grid.move(client_address, pPlayer.x, pPlayer.y)
+
+    def push_nearby(self):
+        """
+        Sends every active player the other players in their area of interest,
+        the closest MAX_NEARBY within aoi_radius, whenever those or their
+        positions and health change. A push is resent every
+        nearby_resend_every ticks until the client acks it, and after that
+        nothing goes out until something changes. The grid finds them without
+        looking at anyone further away, so each player's push grows with how
+        crowded their surroundings are, not with how many players are online.
+        """
+        active_players = self.active_players
+        for client_address, data in active_players.items():
+            me = data.player
+            found = self.grid.near(me.x, me.y, self.aoi_radius)
+            if len(found) > protocol.MAX_NEARBY + 1:
+                found.sort(key=itemgetter(1))  # The player themselves is first, at distance 0
+                del found[protocol.MAX_NEARBY + 1:]
+            entries = []
+            for address, _ in found:
+                if address != client_address:
+                    other = active_players[address]
+                    entries.append((other.player_id, other.player.x, other.player.y, other.player.health))
+            entries.sort()
+            entries = tuple(entries)
+
+            data.nearby_ticks += 1
+            if entries == data.nearby:
+                if data.nearby_acked or data.nearby_ticks < self.nearby_resend_every:
+                    continue
+            else:
+                data.nearby = entries
+                data.nearby_seq += 1
+                data.nearby_acked = False
+            message = protocol.encode_nearby(data.nearby_seq, entries, data.binary)
+            self.send_bytes(message, client_address)
+            data.nearby_ticks = 0
+            self.nearby_totals["pushes"] += 1
+            self.nearby_totals["bytes"] += len(message)
+
+    def announce(self, message):
+        # Server-wide announcement, encoded once and sent to every active player on the next tick
+        self.broadcaster.broadcast(protocol.encode_announcement(message, False),
+                                   protocol.encode_announcement(message, True))
+
+    def tick(self):
+        # Combat first, so this tick's state pushes carry its results
+        self.combat.advance()
+        self.push_state()
+        self.push_nearby()
+        sendto = self.transport.sendto if self.transport is not None else self.sock.sendto
+        self.broadcaster.tick(self.active_players, sendto)
+
+    def maybe_tick(self):
+        now = time.monotonic()
+        if now - self.last_tick >= self.tick_interval:
+            self.last_tick = now
+            self.tick()
+
+    def memory_per_player(self):
+        """
+        Average bytes held per active player: the Session with its Player,
+        sync state, token and address. Objects shared between players, like
+        interned item names, are only counted once.
+        """
+        if not self.active_players:
+            return 0
+        seen = set()
+        total = sum(deep_size(address, seen) + deep_size(data, seen) for address, data in self.active_players.items())
+        return total / len(self.active_players)
+
+    def end_session(self, client_address, forget_peer=True):
+        data = self.active_players.pop(client_address, None)
+        if data is not None:
+            self.sessions.pop(data.token, None)
+            self.grid.remove(client_address)
+            self.combat.leave(data.player_id, data.player)
+        self.broadcaster.forget(client_address)
+        self.responses.forget(client_address)
+        if forget_peer:
+            # A new client may reuse the address, starting from sequence numbers of its own
+            self.duplicates.forget(client_address)
 
-# --- End of Server class ---
 
+# --- End of Server class ---
 
-# Now takes 'sl' as a parameter
-def handle_client_request(pServer, data, client_address, sl):
+def deep_size(obj, seen):
     """
-    Parses and responds to a single client request.
+    Bytes taken by obj and everything it references that is not in seen yet
+    (ids, updated as it goes), following containers and instance attributes.
+    Classes, functions, modules and enum members are shared and not counted.
     """
+    if id(obj) in seen or isinstance(obj, (type, types.FunctionType, types.ModuleType, Enum)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        children = [*obj.keys(), *obj.values()]
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = obj
+    elif isinstance(obj, (str, bytes, int, float)):
+        children = ()
+    else:
+        children = [vars(obj)] if hasattr(obj, "__dict__") else []
+        for cls in type(obj).__mro__:
+            children.extend(getattr(obj, name) for name in getattr(cls, "__slots__", ()) if hasattr(obj, name))
+    return size + sum(deep_size(child, seen) for child in children)
 
-    if client_address in pServer.active_players:
-        pServer.active_players[client_address]['last_ping'] = time.time()
 
-    parts = data.split()
-    if len(parts) < 3:
-        sl.warning(f"Received malformed data from {client_address}: {data}")
-        return  # Ignore malformed commands
+def stat_values(stats):
+    # The four stored stats as ints, clamped to what SET_STATS accepts: stats saved before it was
+    # range checked would not fit the binary replies and state pushes
+    return (protocol.clamp_int(int(stats["sword_damage"])), protocol.clamp_int(int(stats["shield_defense"])),
+            protocol.clamp_int(int(stats["slaying_potion_strength"])),
+            protocol.clamp_int(int(stats["healing_potion_strength"])))
 
-    command = parts[0]
-    username = parts[1]
-    password = parts[2]
-
-    # --- Handle LOGIN Command ---
-    if command == "LOGIN":
-        player_id = pServer.check_db(username, password)
-        if player_id:
-            # User exists and password is correct
-            sl.info(f"Player {username} (ID: {player_id}) logged in from {client_address}")
-
-            # Create a new player object for them in memory
-            new_player = player.Player()
-            new_player.create_profile(username, password)
-
-            # Load their inventory and stats if available
-            stats = pServer.get_player_stats_in_db(player_id)
-            if stats:
-                new_player.init_stats(
-                    int(stats["sword_damage"]),
-                    int(stats["shield_defense"]),
-                    int(stats["slaying_potion_strength"]),
-                    int(stats["healing_potion_strength"])
-                )
-
-            pServer.active_players[client_address] = {
-                "player": new_player,
-                "last_ping": time.time()
-            }
-
-            pServer.send_data(f"LOGIN_SUCCESS {player_id}", client_address)
-
-            # Increment their login count
-            pServer.players[player_id]["logins"] += 1
-            try:
-                with open(pServer.server_db_path, 'w') as f:
-                    json.dump(pServer.players, f, indent=4)  # Save updated DB
-            except Exception as e:
-                sl.error(f"Error updating server database: {e}")
 
-        else:
-            # User not found or wrong password
-            sl.info(f"Failed login attempt for {username} from {client_address}")
-            pServer.send_data("LOGIN_FAIL Invalid credentials", client_address)
-
-    # --- Handle SIGNUP Command ---
-    elif command == "SIGNUP":
-        if pServer.check_username_exists(username):
-            # Check if username is already taken
+def clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+def printable(data):
+    # For log lines: a memoryview would only show its address
+    return data if isinstance(data, str) else bytes(data)
+
+
+# Every client command, keyed by name. Binary opcodes resolve to the same names in protocol.py.
+COMMANDS = CommandRegistry()
+
+
+def authenticate(pServer, request, client_address):
+    """
+    Returns the player_id for a request: straight from the session when a token
+    was sent, otherwise by checking the username and password.
+    """
+    if request.session is not None:
+        return request.session.player_id
+    if request.password is None:
+        return None
+    player_id = pServer.check_db(request.username, request.password)
+    session = pServer.active_players.get(client_address)
+    if player_id and session is not None and session.player_id == player_id:
+        session.last_ping = time.monotonic()  # Like a token, valid credentials show the client is alive
+    return player_id
+
+
+@COMMANDS.register("LOGIN", credentials=True)
+def handle_login(pServer, request, client_address, sl):
+    username = request.username
+    player_id = pServer.check_db(username, request.password)
+    if player_id and pServer.max_players is not None and client_address not in pServer.active_players \
+            and len(pServer.active_players) >= pServer.max_players:
+        sl.info(f"Rejected login for {username} from {client_address}, server is full.")
+        pServer.send_data("LOGIN_FAIL Server full", client_address)
+    elif player_id:
+        # User exists and password is correct
+        sl.info(f"Player {username} (ID: {player_id}) logged in from {client_address}")
+
+        # Create a new player object for them in memory
+        new_player = player.Player()
+        new_player.create_profile(username, request.password)
+
+        # Load their inventory and stats if available
+        stats = pServer.get_player_stats_in_db(player_id)
+        if stats:
+            new_player.init_stats(*stat_values(stats))
+
+        new_player.x, new_player.y = pServer.spawn_point()
+
+        binary = protocol.BINARY_TAG in request.extra
+        token = pServer.start_session(client_address, player_id, new_player, binary)
+        # Tell the client how often to send heartbeats, and that we speak binary too if it asked
+        tags = f"{protocol.HEARTBEAT_TAG}{pServer.heartbeat_interval():g}"
+        if binary:
+            tags = f"{protocol.BINARY_TAG} {tags}"
+        pServer.send_data(f"LOGIN_SUCCESS {player_id} {token} {tags}", client_address)
+
+        # Increment their login count
+        try:
+            pServer.increment_logins(player_id)
+        except Exception as e:
+            sl.error(f"Error updating server database: {e}")
+
+    else:
+        # User not found or wrong password
+        sl.info(f"Failed login attempt for {username} from {client_address}")
+        pServer.send_data("LOGIN_FAIL Invalid credentials", client_address)
+
+
+@COMMANDS.register("SIGNUP", credentials=True)
+def handle_signup(pServer, request, client_address, sl):
+    username = request.username
+    if pServer.check_username_exists(username):
+        # Check if username is already taken
+        sl.info(f"Failed signup, username {username} already exists.")
+        pServer.send_data("SIGNUP_FAIL Username taken", client_address)
+    else:
+        # Create new player
+        new_player = player.Player()
+        new_player.create_profile(username, request.password)
+
+        # Create a new ID for them, unique across deletes and shards
+        new_player_id = pServer.storage.allocate_player_id()
+
+        # Add them to the persistent database
+        try:
+            pServer.add_player_to_db(new_player_id, new_player)
+        except ValueError:
+            # Lost a race for the username against another worker process
             sl.info(f"Failed signup, username {username} already exists.")
             pServer.send_data("SIGNUP_FAIL Username taken", client_address)
+            return
+
+        sl.info(f"New player {username} signed up with ID {new_player_id}")
+        pServer.send_data(f"SIGNUP_SUCCESS {new_player_id}", client_address)
+
+
+@COMMANDS.register("LOGINS")
+def handle_logins(pServer, request, client_address, sl):
+    player_id = authenticate(pServer, request, client_address)
+    if player_id:
+        sl.info(f"Received login count request from {request.username} (ID: {player_id})")
+        num_logins = pServer.get_num_of_logins(player_id)
+        pServer.reply(request, client_address, "LOGINS_COUNT", num_logins)
+    else:
+        pServer.reply(request, client_address, "LOGINS_FAIL", "Invalid credentials")
+
+
+@COMMANDS.register("SET_STATS", schema=(int, int, int, int))
+def handle_set_stats(pServer, request, client_address, sl):
+    player_id = authenticate(pServer, request, client_address)
+    if player_id:
+        # SET_STATS:value1,value2,... arrives already converted by the schema
+        sword_damage, shield_defense, slaying_potion_strength, healing_potion_strength = request.fields
+        if not protocol.fits_int(*request.fields):
+            # Text stats can be any size, but state pushes and GET_STATS send them as binary ints
+            sl.warning(f"Rejected out of range stats for player {request.username} (ID: {player_id})")
+            pServer.reply(request, client_address, "SET_STATS_FAIL", "Invalid stats")
+            return
+        stats_dict = {
+            "sword_damage": str(sword_damage),
+            "shield_defense": str(shield_defense),
+            "slaying_potion_strength": str(slaying_potion_strength),
+            "healing_potion_strength": str(healing_potion_strength)
+        }
+        pServer.set_player_stats_in_db(player_id, stats_dict)
+        session = pServer.active_players.get(client_address)
+        if session is not None and session.player_id == player_id:
+            # Keep the active player in step, the next state push carries the change
+            session.player.init_stats(sword_damage, shield_defense, slaying_potion_strength, healing_potion_strength)
+            pServer.combat.refresh(player_id)
+        sl.info(f"Updated stats for player {request.username} (ID: {player_id})")
+        pServer.reply(request, client_address, "SET_STATS_SUCCESS")
+
+    else:
+        pServer.reply(request, client_address, "SET_STATS_FAIL", "Invalid credentials")
+
+
+# GET_STATS:<version> is conditional: if the client already has that version it only gets NOT_MODIFIED
+@COMMANDS.register("GET_STATS", schema=(int,), optional=1)
+def handle_get_stats(pServer, request, client_address, sl):
+    player_id = authenticate(pServer, request, client_address)
+    if player_id:
+        stats = pServer.get_player_stats_in_db(player_id)
+        version = stats.get("version", 0) if stats else 0
+        if version and request.fields and request.fields[0] == version:
+            pServer.reply(request, client_address, "GET_STATS_NOT_MODIFIED", version)
+        elif stats:
+            pServer.reply(request, client_address, "GET_STATS_SUCCESS", *stat_values(stats), version)
+            sl.info(f"Sent stats to player {request.username} (ID: {player_id})")
         else:
-            # Create new player
-            new_player = player.Player()
-            new_player.create_profile(username, password)
+            pServer.reply(request, client_address, "GET_STATS_FAIL", "No stats found")
+    else:
+        pServer.reply(request, client_address, "GET_STATS_FAIL", "Invalid credentials")
+
+
+@COMMANDS.register("STATE_ACK", schema=(int,))
+def handle_state_ack(pServer, request, client_address, sl):
+    if request.session is not None:
+        request.session.sync.ack(request.fields[0])
+
+
+# USE_ITEM:<item>,<target player id> queues an item use for the next combat step. Without a
+# target (or 0) the item is used on the sender. The result comes with the next state push.
+@COMMANDS.register("USE_ITEM", schema=(int, int), optional=1)
+def handle_use_item(pServer, request, client_address, sl):
+    player_id = authenticate(pServer, request, client_address)
+    session = pServer.active_players.get(client_address)
+    if not player_id or session is None or session.player_id != player_id:
+        pServer.reply(request, client_address, "USE_ITEM_FAIL", "Invalid credentials")
+        return
+    item = request.fields[0]
+    target_id = str(request.fields[1]) if len(request.fields) > 1 and request.fields[1] else player_id
+    if 0 <= item < len(ITEMS) and pServer.combat.queue(player_id, item, target_id):
+        pServer.reply(request, client_address, "USE_ITEM_SUCCESS")
+    else:
+        pServer.reply(request, client_address, "USE_ITEM_FAIL", "Invalid action")
 
-            # Create a new ID for them (simple increment)
-            new_player_id = str(len(pServer.players) + 1)
 
-            # Add them to the persistent database
-            pServer.add_player_to_db(new_player_id, new_player)
+@COMMANDS.register("NEARBY_ACK", schema=(int,))
+def handle_nearby_ack(pServer, request, client_address, sl):
+    session = request.session
+    if session is not None and request.fields[0] == session.nearby_seq:
+        session.nearby_acked = True
 
 
-            sl.info(f"New player {username} signed up with ID {new_player_id}")
-            pServer.send_data(f"SIGNUP_SUCCESS {new_player_id}", client_address)
+# MOVE:<dx>,<dy> steps the player by up to max_step on each axis. There is no reply, the
+# position the server settled on comes with the next state push.
+@COMMANDS.register("MOVE", schema=(int, int))
+def handle_move(pServer, request, client_address, sl):
+    if request.session is not None:
+        pServer.move_player(client_address, *request.fields)
 
-    elif command == "LOGINS":
-        player_id = pServer.check_db(username, password)
-        if player_id:
-            sl.info(f"Received login count request from {username} (ID: {player_id})")
-            num_logins = pServer.get_num_of_logins(player_id)
-            pServer.send_data(f"LOGINS_COUNT {num_logins}", client_address)
-        else:
-            pServer.send_data("LOGINS_FAIL Invalid credentials", client_address)
-
-    elif command.startswith("SET_STATS"):
-        player_id = pServer.check_db(username, password)
-        if player_id:
-            # Split SET_STATS:value1,value2,...
-            stats_data = command[len("SET_STATS:"):].strip()
-            stats = stats_data.split(",")
-            sword_damage = stats[0]
-            shield_defense = stats[1]
-            slaying_potion_strength = stats[2]
-            healing_potion_strength = stats[3]
-            stats_dict = {
-                "sword_damage": sword_damage,
-                "shield_defense": shield_defense,
-                "slaying_potion_strength": slaying_potion_strength,
-                "healing_potion_strength": healing_potion_strength
-            }
-            pServer.set_player_stats_in_db(player_id, stats_dict)
-            sl.info(f"Updated stats for player {username} (ID: {player_id})")
-            pServer.send_data("SET_STATS_SUCCESS", client_address)
 
-        else:
-            pServer.send_data("SET_STATS_FAIL Invalid credentials", client_address)
-
-    elif command.startswith("GET_STATS"):
-        player_id = pServer.check_db(username, password)
-        if player_id:
-            stats = pServer.get_player_stats_in_db(player_id)
-            if stats:
-                stats_str = f"{stats['sword_damage']},{stats['shield_defense']}," + \
-                            f"{stats['slaying_potion_strength']},{stats['healing_potion_strength']}"
-                pServer.send_data(f"GET_STATS_SUCCESS {stats_str}", client_address)
-                sl.info(f"Sent stats to player {username} (ID: {player_id})")
-            else:
-                pServer.send_data("GET_STATS_FAIL No stats found", client_address)
-        else:
-            pServer.send_data("GET_STATS_FAIL Invalid credentials", client_address)
+@COMMANDS.register("HEARTBEAT")
+def handle_heartbeat(pServer, request, client_address, sl):
+    pass  # Heartbeats with a token take the fast path in handle_client_request, this only sees stray ones
 
-    elif command.startswith("HEARTBEAT"):
-        pass
 
+# Now takes 'sl' as a parameter
+def handle_client_request(pServer, data, client_address, sl):
+    """
+    Parses a single client request and dispatches it to the handler registered
+    in COMMANDS. data is the datagram as received (bytes or a memoryview) or a
+    text command from a batch (str); either way the handlers get a decoded
+    Request with fields converted by the schema. Binary packets are parsed in
+    place and text is only decoded once the packet turns out to be text, so
+    no handler may keep a reference to data itself.
+    """
+
+    token = protocol.heartbeat_token(data)
+    if token is not None:
+        # Fast path for the most common packet: all a heartbeat does is refresh its session
+        session = pServer.get_session(token, client_address)
+        if session is not None:
+            session.last_ping = time.monotonic()
+        return
+
+    if not isinstance(data, str):
+        if reliable.is_reliable(data):
+            handle_reliable(pServer, data, client_address, sl)
+            return
+        if not protocol.is_binary(data):
+            try:
+                data = str(data, "utf-8")
+            except UnicodeDecodeError:
+                sl.warning(f"Received malformed data from {client_address}: {bytes(data)}")
+                return
+
+    if isinstance(data, str):
+        if protocol.is_batch(data):
+            handle_batch(pServer, data, client_address, sl)
+            return
+        request = protocol.parse_text_request(data)
     else:
-        sl.warning(f"Received unknown command from {client_address}: {command}")
+        request = protocol.decode_request(data)
+    if request is None:
+        sl.warning(f"Received malformed data from {client_address}: {printable(data)}")
+        return  # Ignore malformed commands
+
+    if request.token is not None:
+        # Session form: the token sent after LOGIN instead of username + password
+        request.session = pServer.get_session(request.token, client_address)
+        if request.session is not None:
+            request.username = request.session.player.profile.username
+            request.session.last_ping = time.monotonic()  # Any authenticated packet shows the client is alive
+
+    command = COMMANDS.get(request.command)
+    if command is None:
+        sl.warning(f"Received unknown command from {client_address}: {request.command}")
+    elif not command.check(request):
+        sl.warning(f"Received malformed {request.command} from {client_address}: {printable(data)}")
+    else:
+        COMMANDS.run(command, pServer, request, client_address, sl)
+
+
+def handle_batch(pServer, data, client_address, sl):
+    """
+    Runs every command of a BATCH datagram in order and answers with a single
+    BATCH datagram holding their replies.
+    """
+    commands = protocol.split_batch(data)
+    if len(commands) > protocol.MAX_BATCH:
+        sl.warning(f"Batch of {len(commands)} commands from {client_address}, "
+                   f"only running the first {protocol.MAX_BATCH}")
+        commands = commands[:protocol.MAX_BATCH]
+
+    pServer.batch_replies = []
+    try:
+        for command in commands:
+            handle_client_request(pServer, command, client_address, sl)
+    finally:
+        replies = pServer.batch_replies
+        pServer.batch_replies = None
+    if replies:
+        pServer.send_data(protocol.join_batch(replies), client_address)
+
+
+def handle_reliable(pServer, data, client_address, sl):
+    """
+    Unwraps a reliable packet and handles its payload, acking with the reply or
+    with a bare ack for commands that have none. A retransmit of a packet that
+    was already handled never runs twice: it gets the cached reply, or a bare
+    ack once that has been evicted.
+    """
+    packet = reliable.unwrap(data)
+    if packet is None or not packet[0] & reliable.FLAG_DATA:
+        sl.warning(f"Received malformed reliable packet from {client_address}")
+        return
+    _, seq, payload = packet
+
+    if not pServer.duplicates.accept(client_address, seq):
+        cached = pServer.responses.get(client_address, seq, time.monotonic())
+        if cached is not None:
+            sl.info(f"Duplicate message {seq} from {client_address}, resending the cached reply")
+            pServer.send_bytes(cached, client_address)
+        else:
+            sl.info(f"Duplicate message {seq} from {client_address}, acking without handling it again")
+            pServer.send_bytes(reliable.wrap(reliable.FLAG_ACK, seq), client_address)
+        return
+
+    pServer.reply_seq = seq
+    pServer.replied = False
+    try:
+        handle_client_request(pServer, payload, client_address, sl)
+    finally:
+        pServer.reply_seq = None
+    if not pServer.replied:
+        pServer.send_bytes(reliable.wrap(reliable.FLAG_ACK, seq), client_address)
+
+
+def log_metrics(pServer, sl):
+    for line in COMMANDS.timing_report():
+        sl.info(f"Command timing - {line}")
+    totals = pServer.broadcaster.totals
+    if totals["messages"]:
+        sl.info(f"Broadcasts - {totals['messages']} messages, {totals['packets']} packets, "
+                f"{totals['bytes']} bytes, {totals['dropped']} dropped, {totals['errors']} send errors")
+    if pServer.active_players:
+        sl.info(f"Memory - {len(pServer.active_players)} active players, "
+                f"{pServer.memory_per_player():.0f} bytes each")
+    nearby = pServer.nearby_totals
+    if nearby["pushes"]:
+        sl.info(f"Area of interest - {nearby['pushes']} nearby pushes, "
+                f"{nearby['bytes'] / nearby['pushes']:.0f} bytes each")
+    combat = pServer.combat
+    if combat.totals["actions"]:
+        mean = combat.totals["step_time"] / combat.steps * 1e6
+        sl.info(f"Combat - {combat.steps} steps (mean {mean:.1f}us), {combat.totals['actions']} actions "
+                f"({combat.totals['replaced']} replaced), {combat.totals['deaths']} deaths, "
+                f"{combat.totals['skipped_steps']} steps skipped")
 
 
 # Now takes 'sl' as a parameter
@@ -246,33 +704,276 @@ def run_server_loop(pServer, maxPlayers, sl):
     """
     Main loop to listen for and handle client data.
     """
+    pServer.max_players = maxPlayers
+    pServer.sock.settimeout(pServer.tick_interval)  # Wake up at least once per server tick
     try:
         while True:
             data, client_address = pServer.receive_data()
 
-            if data == "TIMEOUT":
-                # Check for timed-out clients
-                pServer.check_for_timeouts()
-                continue
+            if data and data != "TIMEOUT":
+                # Pass the logger instance down to the handler. As in ServerProtocol.datagram_received,
+                # a request that fails is logged and the loop keeps serving everyone else.
+                try:
+                    handle_client_request(pServer, data, client_address, sl)
+                except Exception as e:
+                    sl.error(f"Error handling request from {client_address}: {e}")
+
+            # Check for timed-out clients and write out any pending DB changes. Both run off
+            # the monotonic clock on every iteration, so steady traffic can't starve them.
+            pServer.check_for_timeouts()
+            pServer.maybe_flush()
+            try:
+                pServer.maybe_tick()
+            except Exception as e:
+                sl.error(f"Error in server tick: {e}")  # As in ServerProtocol.on_tick_timer, keep serving
+
+    except KeyboardInterrupt:
+        sl.info("\nShutting down server (KeyboardInterrupt).")
+    finally:
+        pServer.announce("Server shutting down")
+        pServer.tick()
+        try:
+            pServer.flush_db()
+        except Exception as e:
+            sl.error(f"Error flushing server database on shutdown: {e}")
+        log_metrics(pServer, sl)
+        sl.info("Closing server socket.")
+        pServer.close()
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """
+    asyncio front end for a Server. Datagrams go through the same
+    handle_client_request as run_server_loop, but disk writes are deferred and
+    run on a single executor thread, and client timeouts fire from a loop
+    timer armed at the next deadline instead of a recv timeout poll.
+    """
+
+    FLUSH_CHECK_INTERVAL = 0.25  # Seconds between checks for a due write-behind flush
+
+    def __init__(self, pServer, sl):
+        self.pServer = pServer
+        self.sl = sl
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-flush")
+        self.flush_future = None  # At most one flush in flight, so batches land in order
+        self.timeout_timer = None
+        self.flush_timer = None
+        self.tick_timer = None
+
+    def connection_made(self, transport):
+        self.pServer.transport = transport
+        self.flush_timer = self.loop.call_later(self.FLUSH_CHECK_INTERVAL, self.on_flush_timer)
+        self.tick_timer = self.loop.call_later(self.pServer.tick_interval, self.on_tick_timer)
 
-            if data:
-                # Pass the logger instance down to the handler
-                handle_client_request(pServer, data, client_address, sl)
+    def datagram_received(self, data, client_address):
+        try:
+            handle_client_request(self.pServer, data, client_address, self.sl)
+        except Exception as e:
+            self.sl.error(f"Error handling request from {client_address}: {e}")
+        if self.pServer.storage.flush_due():
+            self.schedule_flush()
+        if self.timeout_timer is None:
+            self.arm_timeout_timer()
+
+    def error_received(self, exc):
+        self.sl.error(f"Error receiving data: {exc}")
+
+    def arm_timeout_timer(self):
+        # loop.time() is time.monotonic(), the same clock as last_ping
+        deadline = self.pServer.timeouts.next_deadline()
+        self.timeout_timer = self.loop.call_at(deadline, self.on_timeout_timer) if deadline is not None else None
+
+    def on_timeout_timer(self):
+        self.pServer.check_for_timeouts()
+        self.arm_timeout_timer()
+
+    def on_flush_timer(self):
+        if self.pServer.storage.flush_due():
+            self.schedule_flush()
+        self.flush_timer = self.loop.call_later(self.FLUSH_CHECK_INTERVAL, self.on_flush_timer)
+
+    def on_tick_timer(self):
+        try:
+            self.pServer.tick()
+        except Exception as e:
+            self.sl.error(f"Error in server tick: {e}")
+        self.tick_timer = self.loop.call_later(self.pServer.tick_interval, self.on_tick_timer)
+
+    def schedule_flush(self):
+        if self.flush_future is not None:
+            return  # Picked up by the next check once the running flush is done
+        job = self.pServer.storage.prepare_flush()
+        if job is not None:
+            self.flush_future = self.loop.run_in_executor(self.executor, job)
+            self.flush_future.add_done_callback(self.on_flush_done)
+
+    def on_flush_done(self, future):
+        self.flush_future = None
+        if future.exception() is not None:
+            self.sl.error(f"Error flushing server database: {future.exception()}")
+
+    async def shutdown(self):
+        for timer in (self.timeout_timer, self.flush_timer, self.tick_timer):
+            if timer is not None:
+                timer.cancel()
+        self.pServer.announce("Server shutting down")
+        self.pServer.tick()
+        if self.flush_future is not None:
+            await self.flush_future
+        job = self.pServer.storage.prepare_flush()
+        if job is not None:
+            await self.loop.run_in_executor(self.executor, job)
+        self.executor.shutdown()
+
+
+async def serve_async(pServer, sl):
+    loop = asyncio.get_running_loop()
+    pServer.storage.defer_flushes()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ServerProtocol(pServer, sl), sock=pServer.sock)
+    try:
+        await asyncio.Event().wait()  # Serve until cancelled
+    finally:
+        try:
+            await protocol.shutdown()
+        except Exception as e:
+            sl.error(f"Error flushing server database on shutdown: {e}")
+        transport.close()
+        pServer.transport = None
 
 
+def run_async_server(pServer, maxPlayers, sl):
+    """
+    asyncio counterpart of run_server_loop.
+    """
+    pServer.max_players = maxPlayers
+    try:
+        asyncio.run(serve_async(pServer, sl))
     except KeyboardInterrupt:
         sl.info("\nShutting down server (KeyboardInterrupt).")
     finally:
+        log_metrics(pServer, sl)
         sl.info("Closing server socket.")
         pServer.close()
 
 
+def run_worker(worker_id, host, port, storage_factory, maxPlayers, use_asyncio, combat_factory=CombatSimulation):
+    """
+    Entry point of one worker process started by run_workers.
+    """
+    pServer = Server(host, port, storage=storage_factory(), reuse_port=True, combat=combat_factory())
+    pServer.sl.info(f"Worker {worker_id} (pid {os.getpid()}) listening.")
+    pServer.load_db()
+    if use_asyncio:
+        run_async_server(pServer, maxPlayers, pServer.sl)
+    else:
+        run_server_loop(pServer, maxPlayers, pServer.sl)
+
+
+def run_workers(num_workers, host, port, storage_factory, maxPlayers, use_asyncio, sl,
+                combat_factory=CombatSimulation):
+    """
+    Forks num_workers server processes bound to the same UDP port with SO_REUSEPORT.
+
+    The kernel picks a worker by hashing the client's address, so every datagram
+    from one client lands in the same worker and its session, active_players
+    entry and heartbeat state never need to be shared. Account data has to live
+    in a backend all workers can open at once (SQLite); storage_factory is called
+    inside each worker so every process gets its own connection, and it must
+    commit every write (no write-behind, and no use_asyncio, which defers
+    commits), or one worker's open transaction locks out all the others.
+    maxPlayers is the limit per worker.
+    """
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=run_worker, name=f"server-worker-{i}",
+                           args=(i, host, port, storage_factory, maxPlayers, use_asyncio, combat_factory))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    sl.info(f"Started {num_workers} worker processes on {host}:{port}.")
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the whole process group, the workers shut themselves down
+        sl.info("\nWaiting for workers to shut down (KeyboardInterrupt).")
+        for worker in workers:
+            worker.join()
+
+
 if __name__ == "__main__":
-    # 1. Initialize the server object (this also creates server.sl)
-    server = Server()
+    parser = argparse.ArgumentParser(description="RPG project UDP server")
+    parser.add_argument("--storage", choices=["json", "lazy", "sqlite", "sharded"], default="json",
+                        help="player DB backend (default: server_db.json, lazy: mmap-indexed server_db.json)")
+    parser.add_argument("--shards", type=int, default=4,
+                        help="number of shard files for the sharded backend")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="players kept decoded in memory by the lazy backend")
+    parser.add_argument("--sqlite-path", default="server_db.sqlite3",
+                        help="SQLite DB file, imported from server_db.json when empty")
+    parser.add_argument("--journal", action="store_true",
+                        help="append mutations to a write-ahead log instead of rewriting server_db.json")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="batch DB writes instead of writing on every mutation")
+    parser.add_argument("--flush-interval", type=float, default=1.0,
+                        help="seconds between write-behind flushes")
+    parser.add_argument("--flush-batch-size", type=int, default=100,
+                        help="flush early once this many players are dirty")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve with asyncio, DB writes run on an executor thread (JSON DBs are journaled)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port via SO_REUSEPORT "
+                             "(needs --storage sqlite, no --write-behind or --asyncio)")
+    parser.add_argument("--max-players", type=int, default=8,
+                        help="active players allowed at once (per worker)")
+    parser.add_argument("--no-fsync", action="store_true",
+                        help="skip fsync on DB writes (faster, less crash safe)")
+    parser.add_argument("--numpy-combat", action="store_true",
+                        help="resolve combat steps with vectorized NumPy arrays (needs numpy)")
+    args = parser.parse_args()
+    if args.numpy_combat and not HAVE_NUMPY:
+        parser.error("--numpy-combat needs numpy installed")
+    combat_factory = ArrayCombatSimulation if args.numpy_combat else CombatSimulation
+
+    write_options = dict(write_behind=args.write_behind, flush_interval=args.flush_interval,
+                         flush_batch_size=args.flush_batch_size, fsync=not args.no_fsync)
+
+    def make_storage():
+        if args.storage == "sqlite":
+            return SqliteStorage(args.sqlite_path, import_path="server_db.json", **write_options)
+        elif args.storage == "sharded":
+            return ShardedStorage("server_db.json", num_shards=args.shards, import_path="server_db.json",
+                                  journaled=args.journal, **write_options)
+        elif args.storage == "lazy":
+            return LazyJsonStorage("server_db.json", cache_size=args.cache_size, **write_options)
+        return JsonFileStorage("server_db.json", journaled=args.journal, **write_options)
+
+    if args.workers > 1:
+        if args.storage != "sqlite":
+            parser.error("--workers needs --storage sqlite, the JSON backends can't be shared between processes")
+        if args.write_behind or args.asyncio:
+            # A batched SQLite write keeps its transaction, and the DB write lock, open until the next
+            # flush (--asyncio defers every flush to its executor the same way), so every other worker's
+            # writes would stall and then fail with "database is locked"
+            parser.error("--workers can't be combined with --write-behind or --asyncio, "
+                         "each worker has to commit its writes")
+        # Create (and import) the DB once up front instead of racing in every worker
+        setup_storage = make_storage()
+        setup_storage.load()
+        setup_storage.close()
+        run_workers(args.workers, 'localhost', 9999, make_storage, args.max_players, args.asyncio, ServerLogger(),
+                    combat_factory)
+    else:
+        # 1. Initialize the server object (this also creates server.sl)
+        server = Server(storage=make_storage(), combat=combat_factory())
 
-    # 2. Load persistent data (uses server.sl internally)
-    server.load_db()
+        # 2. Load persistent data (uses server.sl internally)
+        server.load_db()
 
-    # 3. Run the main loop, passing the server's logger instance
-    run_server_loop(server, 8, server.sl)
\ No newline at end of file
+        # 3. Run the main loop, passing the server's logger instance
+        if args.asyncio:
+            run_async_server(server, args.max_players, server.sl)
+        else:
+            run_server_loop(server, args.max_players, server.sl)
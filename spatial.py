@@ -0,0 +1,71 @@
+# spatial.py
+# Uniform grid over player positions, for finding the players near a point
+
+
+class SpatialGrid:
+    """
+    Buckets keys by the cell_size square their position falls in. move() only
+    touches the buckets when a key crosses into another cell, and near() only
+    looks at the cells overlapping the query circle, so a query costs O(k) in
+    the keys around the point rather than O(n) in all of them. With cell_size
+    equal to the query radius that is the 3x3 cells around the point.
+    """
+
+    def __init__(self, cell_size=100):
+        self.cell_size = cell_size
+        self.cells = {}  # (cell x, cell y) -> set of keys
+        self.positions = {}  # key -> (x, y)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell(self, x, y):
+        return x // self.cell_size, y // self.cell_size
+
+    def insert(self, key, x, y):
+        self.positions[key] = (x, y)
+        self.cells.setdefault(self.cell(x, y), set()).add(key)
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is not None:
+            self.discard(self.cell(*position), key)
+
+    def discard(self, cell, key):
+        bucket = self.cells[cell]
+        bucket.discard(key)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, key, x, y):
+        old = self.positions.get(key)
+        if old is None:
+            self.insert(key, x, y)
+            return
+        self.positions[key] = (x, y)
+        old_cell = self.cell(*old)
+        new_cell = self.cell(x, y)
+        if old_cell != new_cell:
+            self.discard(old_cell, key)
+            self.cells.setdefault(new_cell, set()).add(key)
+
+    def near(self, x, y, radius):
+        """
+        Returns (key, squared distance) for every key within radius of (x, y).
+        """
+        size = self.cell_size
+        cells = self.cells
+        positions = self.positions
+        max_distance = radius * radius
+        found = []
+        for cell_x in range((x - radius) // size, (x + radius) // size + 1):
+            for cell_y in range((y - radius) // size, (y + radius) // size + 1):
+                bucket = cells.get((cell_x, cell_y))
+                if not bucket:
+                    continue
+                for key in bucket:
+                    key_x, key_y = positions[key]
+                    distance = (key_x - x) * (key_x - x) + (key_y - y) * (key_y - y)
+                    if distance <= max_distance:
+                        found.append((key, distance))
+        return found
@@ -0,0 +1,969 @@
+# storage.py
+# Persistence helpers for the server player database
+
+import json, os, re, time, mmap, sqlite3, zlib
+from array import array
+from collections import OrderedDict
+
+
+def write_json_atomic(path, data, fsync=True):
+    """
+    Writes data to path through a temp file and os.replace, so a crash
+    mid-write leaves either the old file or the new one, never a torn one.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def next_numeric_id(player_ids):
+    """
+    Returns one past the highest numeric player id, as an int.
+    """
+    return max((int(pid) for pid in player_ids if pid.isdigit()), default=0) + 1
+
+
+class PlayerJournal:
+    """
+    Append-only write-ahead log on top of a JSON snapshot of the player DB.
+
+    Every mutation is one small JSON line in <snapshot>.log. Records carry
+    absolute values (never increments), so replaying the same record twice is
+    harmless. That makes a crash between writing a new snapshot and truncating
+    the log safe.
+    """
+
+    def __init__(self, snapshot_path, compact_every=1000, fsync=True):
+        self.snapshot_path = snapshot_path
+        self.log_path = snapshot_path + ".log"
+        self.compact_every = compact_every  # Records in the log before a snapshot is written
+        self.fsync = fsync
+        self.records_since_compact = 0
+        self.log_file = None
+
+    def load(self):
+        """
+        Returns the players dict rebuilt from the snapshot plus the log.
+        """
+        players = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                players = json.load(f)
+        for record in self.read_log():
+            self.apply(players, record)
+        return players
+
+    def read_log(self):
+        """
+        Returns every complete record in the log and opens it for appending.
+        A torn record at the end of the log (crash mid-append) is dropped.
+        """
+        records = []
+        good_offset = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn write, everything after it is garbage
+                    if not line.endswith(b"\n"):
+                        break
+                    records.append(record)
+                    good_offset += len(line)
+
+            if good_offset != os.path.getsize(self.log_path):
+                with open(self.log_path, 'r+b') as f:
+                    f.truncate(good_offset)
+
+        self.records_since_compact = len(records)
+        self.log_file = open(self.log_path, 'ab')
+        return records
+
+    @staticmethod
+    def apply(players, record):
+        op = record["op"]
+        player_id = record["id"]
+        if op == "put":
+            players[player_id] = record["data"]
+        elif op == "set":
+            if player_id in players:
+                players[player_id].update(record["data"])
+        elif op == "del":
+            players.pop(player_id, None)
+
+    def append(self, records):
+        """
+        Appends (op, player_id, data) records to the log in a single write.
+        """
+        if self.log_file is None:
+            self.log_file = open(self.log_path, 'ab')
+        lines = "".join(
+            json.dumps({"op": op, "id": player_id, "data": data}, separators=(",", ":")) + "\n"
+            for op, player_id, data in records
+        )
+        self.log_file.write(lines.encode())
+        self.log_file.flush()
+        if self.fsync:
+            os.fsync(self.log_file.fileno())
+        self.records_since_compact += len(records)
+
+    def needs_compaction(self):
+        return self.records_since_compact >= self.compact_every
+
+    def compact(self, players):
+        """
+        Writes a fresh snapshot of players and empties the log.
+        """
+        write_json_atomic(self.snapshot_path, players, self.fsync)
+        self.truncate()
+
+    def truncate(self):
+        """
+        Empties the log, called once its records are part of a snapshot.
+        """
+        if self.log_file is not None:
+            self.log_file.close()
+        self.log_file = open(self.log_path, 'wb')
+        self.records_since_compact = 0
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+class PlayerStorage:
+    """
+    Template class for player DB backends used by the Server.
+
+    Player records are dicts shaped like the entries in server_db.json:
+    {"username": ..., "password": ..., "logins": ..., "stats": {...}}.
+    """
+
+    sl = None  # Logger, set by the Server that owns the storage
+    deferred = False  # Set by defer_flushes()
+
+    def load(self) -> None:
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def get_player(self, player_id):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def find_player_id(self, username):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def add_player(self, player_id, record) -> None:
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def update_player(self, player_id, fields) -> None:
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def remove_player(self, player_id) -> None:
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def count_players(self) -> int:
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def allocate_player_id(self) -> str:
+        """
+        Returns a new, never used player id. Unlike len(players) + 1 this stays
+        unique after deletes and across shards.
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def increment_logins(self, player_id) -> None:
+        record = self.get_player(player_id)
+        if record is not None:
+            # Store the absolute count so journal replays stay idempotent
+            self.update_player(player_id, {"logins": record["logins"] + 1})
+
+    def flush(self) -> None:
+        pass
+
+    def flush_due(self) -> bool:
+        return False
+
+    def maybe_flush(self) -> None:
+        if self.flush_due():
+            self.flush()
+
+    def defer_flushes(self) -> None:
+        """
+        Switches to write-behind and stops flushing inline when a batch fills up.
+        The owner polls flush_due() and runs the job from prepare_flush() itself,
+        e.g. on an executor thread.
+        """
+        self.deferred = True
+
+    def prepare_flush(self):
+        """
+        Takes everything pending and returns a callable that writes it to disk,
+        or None. The callable only touches data captured here, so it may run on
+        another thread while the storage keeps being used.
+        """
+        self.flush()
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+class JsonFileStorage(PlayerStorage):
+    """
+    The original server_db.json backend: every player lives in one dict that is
+    either rewritten wholesale or, in journaled mode, appended to a PlayerJournal.
+    """
+
+    def __init__(self, path="server_db.json", journaled=False, write_behind=False,
+                 flush_interval=1.0, flush_batch_size=100, fsync=True):
+        self.path = path
+        self.players = {}
+        self.username_index = {}  # username -> player_id, kept in sync with self.players
+        self.next_player_id = 1
+        # In journaled mode mutations are appended to <path>.log instead of rewriting the DB
+        self.journal = PlayerJournal(path, fsync=fsync) if journaled else None
+        self.fsync = fsync  # False trades crash safety for cheaper writes
+
+        # Write-behind: mutations only mark the player dirty, flush writes them in one batch
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval  # Seconds a dirty record may wait before being flushed
+        self.flush_batch_size = flush_batch_size  # Flush early once this many players are dirty
+        self.dirty_players = set()
+        self.last_flush = time.monotonic()
+
+    def load(self):
+        if self.journal is not None:
+            self.players = self.journal.load()
+            if self.sl:
+                self.sl.info(f"Replayed {self.journal.records_since_compact} journal records.")
+        elif os.path.exists(self.path + ".log"):
+            # Left by a journaled run (--journal, or --asyncio, see defer_flushes), folded back into the DB
+            journal = PlayerJournal(self.path, fsync=self.fsync)
+            self.players = journal.load()
+            journal.compact(self.players)
+            journal.close()
+            os.remove(journal.log_path)
+        elif os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.players = json.load(f)
+        else:
+            self.players = {}
+        self.rebuild_username_index()
+        self.next_player_id = next_numeric_id(self.players)
+
+    def import_players(self, players):
+        """
+        Replaces every player with players (player_id -> record) and writes them
+        out once, as a snapshot in journaled mode, instead of once per player.
+        """
+        self.players = players
+        self.rebuild_username_index()
+        self.next_player_id = next_numeric_id(players)
+        self.dirty_players = set()
+        if self.journal is not None:
+            self.compact()
+        else:
+            self.save()
+
+    def rebuild_username_index(self):
+        """
+        Rebuilds the username -> player_id lookup table from self.players.
+        """
+        self.username_index = {pdata["username"]: pid for pid, pdata in self.players.items()}
+
+    def get_player(self, player_id):
+        return self.players.get(player_id)
+
+    def find_player_id(self, username):
+        return self.username_index.get(username)
+
+    def add_player(self, player_id, record):
+        self.players[player_id] = record
+        self.username_index[record["username"]] = player_id
+        if player_id.isdigit():
+            self.next_player_id = max(self.next_player_id, int(player_id) + 1)
+        self.persist_change("put", player_id, record)
+
+    def update_player(self, player_id, fields):
+        record = self.players.get(player_id)
+        if record is None:
+            return
+        if "username" in fields and fields["username"] != record["username"]:
+            del self.username_index[record["username"]]
+            self.username_index[fields["username"]] = player_id
+        record.update(fields)
+        self.persist_change("set", player_id, fields)
+
+    def remove_player(self, player_id):
+        record = self.players.pop(player_id, None)
+        if record is not None:
+            self.username_index.pop(record["username"], None)
+            self.persist_change("del", player_id)
+
+    def count_players(self):
+        return len(self.players)
+
+    def allocate_player_id(self):
+        player_id = str(self.next_player_id)
+        self.next_player_id += 1
+        return player_id
+
+    def save(self):
+        write_json_atomic(self.path, self.players, self.fsync)
+
+    def persist_change(self, op, player_id, data=None):
+        """
+        Records a single mutation. With write-behind the player is only marked
+        dirty, otherwise the change is written to disk right away.
+        """
+        if self.write_behind or self.deferred:
+            self.dirty_players.add(player_id)
+            if not self.deferred and len(self.dirty_players) >= self.flush_batch_size:
+                self.flush()
+            return
+        self.write_changes([(op, player_id, data)])
+
+    def write_changes(self, records):
+        """
+        Writes (op, player_id, data) records to disk. In journaled mode they are
+        appended to the log (compacting when it grows), otherwise the whole DB is rewritten.
+        """
+        if self.journal is None:
+            self.save()
+            return
+        self.journal.append(records)
+        if self.journal.needs_compaction():
+            self.compact()
+            if self.sl:
+                self.sl.info("Server database journal compacted.")
+
+    def compact(self):
+        self.journal.compact(self.players)
+
+    def flush(self):
+        """
+        Writes every dirty player in one batch (one append + fsync, or one rewrite).
+        """
+        job = self.prepare_flush()
+        if job is not None:
+            job()
+
+    def flush_due(self):
+        if not self.dirty_players:
+            return False
+        return (len(self.dirty_players) >= self.flush_batch_size or
+                time.monotonic() - self.last_flush >= self.flush_interval)
+
+    def prepare_flush(self):
+        self.last_flush = time.monotonic()
+        if not self.dirty_players:
+            return None
+        # A dirty player is written as a copy of its full current record, so repeated
+        # updates to the same player collapse into a single journal line
+        records = []
+        for pid in self.dirty_players:
+            record = self.players.get(pid)
+            records.append(("put", pid, dict(record)) if record is not None else ("del", pid, None))
+        self.dirty_players = set()
+
+        if self.journal is None:
+            players = self.copy_players()
+            return lambda: write_json_atomic(self.path, players, self.fsync)
+        if self.journal.records_since_compact + len(records) < self.journal.compact_every:
+            return lambda: self.journal.append(records)
+        return self.prepare_compaction(records)
+
+    def prepare_compaction(self, records):
+        players = self.copy_players()
+
+        def append_and_compact():
+            self.journal.append(records)
+            self.journal.compact(players)
+            if self.sl:
+                self.sl.info("Server database journal compacted.")
+        return append_and_compact
+
+    def defer_flushes(self):
+        super().defer_flushes()
+        if self.journal is None:
+            # A rewrite needs a copy of every player, taken on the caller's thread, for each flush;
+            # a journal append only copies the dirty ones. The current DB becomes the snapshot.
+            self.journal = PlayerJournal(self.path, fsync=self.fsync)
+            self.journal.compact(self.players)
+
+    def copy_players(self):
+        # Records are only ever changed through dict.update, so a copy one level deep is enough
+        return {pid: dict(record) for pid, record in self.players.items()}
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+class LazyJsonStorage(JsonFileStorage):
+    """
+    Fast-startup variant of JsonFileStorage for large server_db.json files.
+
+    load() mmaps the snapshot and only builds a compact offset index (a
+    player_id -> slot dict over two int arrays) plus the username index,
+    cached in a <path>.idx sidecar. Full records
+    are decoded on first access (e.g. at LOGIN) and kept in an LRU cache of
+    cache_size entries, so memory tracks the active players, not all accounts.
+
+    Writes always go through the journal. Records changed since the last
+    snapshot stay pinned in self.players (None marks a deleted player), and
+    compaction streams a new snapshot, copying untouched records straight
+    out of the old mmap.
+    """
+
+    # A top-level entry as written by json.dump(..., indent=4), username first.
+    # The literal prefix lets the regex engine skip ahead with a fast search.
+    ENTRY_PATTERN = re.compile(
+        rb'\n    "((?:[^"\\\n]|\\.)*)": (\{)\n        "username": "((?:[^"\\\n]|\\.)*)"')
+
+    def __init__(self, path="server_db.json", cache_size=10000, write_behind=False,
+                 flush_interval=1.0, flush_batch_size=100, fsync=True):
+        super().__init__(path, journaled=True, write_behind=write_behind, flush_interval=flush_interval,
+                         flush_batch_size=flush_batch_size, fsync=fsync)
+        self.index_path = path + ".idx"
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # player_id -> record, least recently used first
+        self.slots = {}  # player_id -> slot in record_offsets / record_lengths
+        self.record_offsets = array('q')
+        self.record_lengths = array('q')
+        self.num_players = 0
+        self.replaying = False
+        self.db_file = None
+        self.mm = None
+
+    def load(self):
+        self.players = {}
+        self.cache.clear()
+        self.open_snapshot()
+        self.num_players = len(self.slots)
+        self.next_player_id = next_numeric_id(self.slots)
+
+        # Replay the journal through the normal mutators, without re-journaling it
+        self.replaying = True
+        try:
+            for record in self.journal.read_log():
+                if record["op"] == "put":
+                    self.add_player(record["id"], record["data"])
+                elif record["op"] == "set":
+                    self.update_player(record["id"], record["data"])
+                elif record["op"] == "del":
+                    self.remove_player(record["id"])
+        finally:
+            self.replaying = False
+        if self.sl:
+            self.sl.info(f"Indexed {len(self.slots)} players, replayed "
+                         f"{self.journal.records_since_compact} journal records.")
+
+    def open_snapshot(self):
+        self.close_snapshot()
+        self.slots = {}
+        self.record_offsets = array('q')
+        self.record_lengths = array('q')
+        self.username_index = {}
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+
+        self.db_file = open(self.path, 'rb')
+        self.mm = mmap.mmap(self.db_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.load_sidecar_index():
+            return
+
+        self.scan_snapshot()
+        if not self.slots and self.mm[:].strip() != b"{}":
+            # Not in the indent=4 layout json.dump writes (hand edited or compact),
+            # rewrite it once so it can be indexed
+            players = json.loads(self.mm[:])
+            self.close_snapshot()
+            write_json_atomic(self.path, players, self.fsync)
+            self.open_snapshot()
+            return
+        self.save_sidecar_index()
+
+    def scan_snapshot(self):
+        """
+        Builds the offset and username indexes with one regex pass over the mmap.
+        """
+        player_ids = []
+        usernames = []
+        for match in self.ENTRY_PATTERN.finditer(self.mm):
+            if self.record_offsets:
+                # The previous record ends right before the ",\n" that precedes this entry
+                self.record_lengths.append(match.start() - 1 - self.record_offsets[-1])
+            self.record_offsets.append(match.start(2))
+            player_ids.append(self.decode_key(match.group(1)))
+            usernames.append(self.decode_key(match.group(3)))
+        if self.record_offsets:
+            self.record_lengths.append(self.mm.rfind(b"\n}") - self.record_offsets[-1])
+
+        self.slots = dict(zip(player_ids, range(len(player_ids))))
+        self.username_index = dict(zip(usernames, player_ids))
+
+    @staticmethod
+    def decode_key(raw):
+        # Only strings with escapes need the (slower) JSON decoder
+        return json.loads(b'"' + raw + b'"') if b"\\" in raw else raw.decode()
+
+    def load_sidecar_index(self):
+        """
+        The sidecar is a JSON header line, the offset and length arrays, then the
+        newline-joined player ids and usernames. It is only trusted while the
+        snapshot's size and mtime match the header.
+        """
+        if not os.path.exists(self.index_path):
+            return False
+        stat = os.stat(self.path)
+        with open(self.index_path, 'rb') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return False
+            if header.get("size") != stat.st_size or header.get("mtime_ns") != stat.st_mtime_ns:
+                return False  # Snapshot changed behind our back
+            count = header["count"]
+            self.record_offsets.fromfile(f, count)
+            self.record_lengths.fromfile(f, count)
+            names = f.read().decode().split("\0")
+
+        player_ids = names[0].split("\n") if count else []
+        usernames = names[1].split("\n") if count else []
+        self.slots = dict(zip(player_ids, range(count)))
+        self.username_index = dict(zip(usernames, player_ids))
+        return True
+
+    def save_sidecar_index(self):
+        usernames = {pid: username for username, pid in self.username_index.items()}
+        player_ids = list(self.slots)
+        names = ["\n".join(player_ids), "\n".join(usernames[pid] for pid in player_ids)]
+        if any(name.count("\n") != len(player_ids) - 1 or "\0" in name for name in names if player_ids):
+            return  # An id or username with a newline in it, scan the snapshot next time instead
+        stat = os.stat(self.path)
+        header = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "count": len(player_ids)}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            self.record_offsets.tofile(f)
+            self.record_lengths.tofile(f)
+            f.write("\0".join(names).encode())
+        os.replace(tmp_path, self.index_path)
+
+    def close_snapshot(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.db_file is not None:
+            self.db_file.close()
+            self.db_file = None
+
+    def get_player(self, player_id):
+        if player_id in self.players:
+            return self.players[player_id]
+        record = self.cache.get(player_id)
+        if record is not None:
+            self.cache.move_to_end(player_id)
+            return record
+        slot = self.slots.get(player_id)
+        if slot is None:
+            return None
+
+        offset = self.record_offsets[slot]
+        record = json.loads(self.mm[offset:offset + self.record_lengths[slot]])
+        self.cache[player_id] = record
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)  # Evict the coldest record
+        return record
+
+    def add_player(self, player_id, record):
+        existing = self.get_player(player_id)
+        if existing is None:
+            self.num_players += 1
+        elif existing["username"] != record["username"]:
+            self.username_index.pop(existing["username"], None)
+        self.cache.pop(player_id, None)
+        super().add_player(player_id, record)
+
+    def update_player(self, player_id, fields):
+        record = self.get_player(player_id)
+        if record is None:
+            return
+        # Pin the record: once changed it can't be re-read from the snapshot
+        self.players[player_id] = record
+        self.cache.pop(player_id, None)
+        super().update_player(player_id, fields)
+
+    def remove_player(self, player_id):
+        record = self.get_player(player_id)
+        if record is None:
+            return
+        self.players[player_id] = None
+        self.cache.pop(player_id, None)
+        self.username_index.pop(record["username"], None)
+        self.num_players -= 1
+        self.persist_change("del", player_id)
+
+    def count_players(self):
+        return self.num_players
+
+    def persist_change(self, op, player_id, data=None):
+        if not self.replaying:
+            super().persist_change(op, player_id, data)
+
+    def prepare_compaction(self, records):
+        # Compaction streams out of the live mmap, so it runs right here instead
+        # of being handed to another thread
+        self.journal.append(records)
+        self.compact()
+        if self.sl:
+            self.sl.info("Server database journal compacted.")
+        return None
+
+    def compact(self):
+        """
+        Streams a new snapshot in the same layout as json.dump(..., indent=4),
+        then swaps it in, re-maps it and empties the journal.
+        """
+        usernames = {pid: username for username, pid in self.username_index.items()}
+        player_ids = list(self.slots) + [pid for pid in self.players if pid not in self.slots]
+        slots = {}
+        record_offsets = array('q')
+        record_lengths = array('q')
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b"{")
+            for player_id in player_ids:
+                if player_id in self.players:
+                    record = self.players[player_id]
+                    if record is None:
+                        continue
+                    body = json.dumps(record, indent=4).replace("\n", "\n    ").encode()
+                else:
+                    slot = self.slots[player_id]
+                    offset = self.record_offsets[slot]
+                    body = self.mm[offset:offset + self.record_lengths[slot]]
+                f.write(b",\n    " if slots else b"\n    ")
+                f.write(json.dumps(player_id).encode() + b": ")
+                slots[player_id] = len(record_offsets)
+                record_offsets.append(f.tell())
+                record_lengths.append(len(body))
+                f.write(body)
+            f.write(b"\n}")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+        self.close_snapshot()
+        os.replace(tmp_path, self.path)
+        self.db_file = open(self.path, 'rb')
+        self.mm = mmap.mmap(self.db_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.slots = slots
+        self.record_offsets = record_offsets
+        self.record_lengths = record_lengths
+        self.username_index = {usernames[pid]: pid for pid in slots}
+        self.save_sidecar_index()
+        self.players = {}
+        self.journal.truncate()
+
+    def close(self):
+        super().close()
+        self.close_snapshot()
+
+
+class SqliteStorage(PlayerStorage):
+    """
+    SQLite backend. Usernames are looked up through a UNIQUE index, every query
+    is a fixed parameterized statement (so sqlite3's statement cache keeps it
+    prepared) and the database runs in WAL mode.
+
+    With write_behind the transaction is kept open and committed in batches,
+    like JsonFileStorage's dirty set.
+
+    Several server processes may share one database file: player ids are
+    handed out by a single INSERT and a duplicate username is reported as a
+    ValueError, so concurrent signups in different workers stay consistent.
+    """
+
+    # Only these columns may be written through update_player
+    UPDATE_STATEMENTS = {
+        "username": "UPDATE players SET username = ? WHERE player_id = ?",
+        "password": "UPDATE players SET password = ? WHERE player_id = ?",
+        "logins": "UPDATE players SET logins = ? WHERE player_id = ?",
+        "stats": "UPDATE players SET stats = ? WHERE player_id = ?",
+    }
+
+    def __init__(self, path="server_db.sqlite3", import_path=None, write_behind=False,
+                 flush_interval=1.0, flush_batch_size=100, fsync=True):
+        self.path = path
+        self.import_path = import_path  # server_db.json to migrate from when the DB is empty
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.fsync = fsync
+        self.pending_writes = 0
+        self.last_flush = time.monotonic()
+        self.conn = None
+
+    def load(self):
+        # isolation_level=None: transactions are opened explicitly in write()
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS players ("
+            " player_id INTEGER PRIMARY KEY,"
+            " username TEXT NOT NULL UNIQUE,"
+            " password TEXT NOT NULL,"
+            " logins INTEGER NOT NULL DEFAULT 0,"
+            " stats TEXT)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS player_id_seq (id INTEGER PRIMARY KEY)")
+        if self.import_path and self.count_players() == 0 and os.path.exists(self.import_path):
+            self.import_json(self.import_path)
+
+    def import_json(self, json_path):
+        with open(json_path, 'r') as f:
+            players = json.load(f)
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for pid, pdata in players.items():
+                self.conn.execute(
+                    "INSERT INTO players (player_id, username, password, logins, stats) VALUES (?, ?, ?, ?, ?)",
+                    (int(pid), pdata["username"], pdata["password"], pdata.get("logins", 0),
+                     json.dumps(pdata["stats"]) if "stats" in pdata else None))
+        if self.sl:
+            self.sl.info(f"Imported {len(players)} players from {json_path} into {self.path}.")
+
+    @staticmethod
+    def row_to_record(row):
+        record = {"username": row[0], "password": row[1], "logins": row[2]}
+        if row[3] is not None:
+            record["stats"] = json.loads(row[3])
+        return record
+
+    def get_player(self, player_id):
+        row = self.conn.execute(
+            "SELECT username, password, logins, stats FROM players WHERE player_id = ?",
+            (int(player_id),)).fetchone()
+        return self.row_to_record(row) if row else None
+
+    def find_player_id(self, username):
+        row = self.conn.execute("SELECT player_id FROM players WHERE username = ?", (username,)).fetchone()
+        return str(row[0]) if row else None
+
+    def count_players(self):
+        return self.conn.execute("SELECT COUNT(*) FROM players").fetchone()[0]
+
+    def allocate_player_id(self):
+        # A single statement takes the write lock, so two workers can't be handed the same id
+        cursor = self.conn.execute(
+            "INSERT INTO player_id_seq (id) SELECT MAX(COALESCE((SELECT MAX(id) FROM player_id_seq), 0),"
+            " COALESCE((SELECT MAX(player_id) FROM players), 0)) + 1")
+        return str(cursor.lastrowid)
+
+    def write(self, sql, params):
+        """
+        Runs one mutating statement, committing right away or in write-behind batches.
+        """
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self.conn.execute(sql, params)
+        self.pending_writes += 1
+        if self.deferred:
+            return
+        if not self.write_behind or self.pending_writes >= self.flush_batch_size:
+            self.flush()
+
+    def add_player(self, player_id, record):
+        try:
+            self.write(
+                "INSERT INTO players (player_id, username, password, logins, stats) VALUES (?, ?, ?, ?, ?)",
+                (int(player_id), record["username"], record["password"], record.get("logins", 0),
+                 json.dumps(record["stats"]) if "stats" in record else None))
+        except sqlite3.IntegrityError:
+            # Another worker process took the username since check_username_exists
+            raise ValueError(f"Username {record['username']} is already taken.")
+
+    def update_player(self, player_id, fields):
+        for field, value in fields.items():
+            if field == "stats":
+                value = json.dumps(value)
+            self.write(self.UPDATE_STATEMENTS[field], (value, int(player_id)))
+
+    def increment_logins(self, player_id):
+        self.write("UPDATE players SET logins = logins + 1 WHERE player_id = ?", (int(player_id),))
+
+    def remove_player(self, player_id):
+        self.write("DELETE FROM players WHERE player_id = ?", (int(player_id),))
+
+    def flush(self):
+        job = self.prepare_flush()
+        if job is not None:
+            job()
+
+    def flush_due(self):
+        if not self.pending_writes:
+            return False
+        return (self.pending_writes >= self.flush_batch_size or
+                time.monotonic() - self.last_flush >= self.flush_interval)
+
+    def prepare_flush(self):
+        # The statements already ran, only the COMMIT (and its fsync) is left to do.
+        # The connection is opened with check_same_thread=False for this.
+        self.last_flush = time.monotonic()
+        self.pending_writes = 0
+        if self.conn is None or not self.conn.in_transaction:
+            return None
+        return self.commit
+
+    def commit(self):
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+
+class ShardedStorage(PlayerStorage):
+    """
+    Splits the player DB into num_shards JsonFileStorage files, picked by a
+    hash of player_id. Each shard is loaded and flushed on its own, so a change
+    only rewrites (or appends to) the shard that holds that player.
+
+    Usernames are indexed across all shards here, and player ids come from one
+    counter so they stay unique no matter which shard they land in. The shard
+    count is recorded in <path>.shards.json, because changing it would move
+    players to other shards.
+    """
+
+    def __init__(self, path="server_db.json", num_shards=4, import_path=None, **shard_options):
+        base, ext = os.path.splitext(path)
+        self.meta_path = f"{base}.shards.json"
+        self.num_shards = num_shards
+        self.import_path = import_path  # Unsharded server_db.json to split up on first start
+        self.shards = [JsonFileStorage(f"{base}.shard{i}{ext}", **shard_options) for i in range(num_shards)]
+        self.username_index = {}
+        self.next_player_id = 1
+
+    def shard_index(self, player_id):
+        return zlib.crc32(player_id.encode()) % self.num_shards
+
+    def shard_for(self, player_id):
+        return self.shards[self.shard_index(player_id)]
+
+    def load(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta["num_shards"] != self.num_shards:
+                raise ValueError(f"{self.meta_path} was written with {meta['num_shards']} shards, "
+                                 f"not {self.num_shards}")
+
+        for shard in self.shards:
+            shard.sl = self.sl
+            shard.load()
+        self.rebuild_indexes()
+
+        if not os.path.exists(self.meta_path):
+            if self.import_path and self.count_players() == 0 and os.path.exists(self.import_path):
+                self.import_json(self.import_path)
+            write_json_atomic(self.meta_path, {"num_shards": self.num_shards})
+
+    def rebuild_indexes(self):
+        self.username_index = {}
+        for shard in self.shards:
+            self.username_index.update(shard.username_index)
+        self.next_player_id = max(shard.next_player_id for shard in self.shards)
+
+    def import_json(self, json_path):
+        # Split up front and write each shard once: add_player would rewrite a shard per player
+        with open(json_path, 'r') as f:
+            players = json.load(f)
+        split = [{} for _ in self.shards]
+        for player_id, record in players.items():
+            split[self.shard_index(player_id)][player_id] = record
+        for shard, shard_players in zip(self.shards, split):
+            shard.import_players(shard_players)
+        self.rebuild_indexes()
+        if self.sl:
+            self.sl.info(f"Split {len(players)} players from {json_path} into {self.num_shards} shards.")
+
+    def get_player(self, player_id):
+        return self.shard_for(player_id).get_player(player_id)
+
+    def find_player_id(self, username):
+        return self.username_index.get(username)
+
+    def add_player(self, player_id, record):
+        self.shard_for(player_id).add_player(player_id, record)
+        self.username_index[record["username"]] = player_id
+        if player_id.isdigit():
+            self.next_player_id = max(self.next_player_id, int(player_id) + 1)
+
+    def update_player(self, player_id, fields):
+        shard = self.shard_for(player_id)
+        record = shard.get_player(player_id)
+        if record is None:
+            return
+        if "username" in fields and fields["username"] != record["username"]:
+            del self.username_index[record["username"]]
+            self.username_index[fields["username"]] = player_id
+        shard.update_player(player_id, fields)
+
+    def remove_player(self, player_id):
+        shard = self.shard_for(player_id)
+        record = shard.get_player(player_id)
+        if record is not None:
+            self.username_index.pop(record["username"], None)
+            shard.remove_player(player_id)
+
+    def count_players(self):
+        return sum(shard.count_players() for shard in self.shards)
+
+    def allocate_player_id(self):
+        player_id = str(self.next_player_id)
+        self.next_player_id += 1
+        return player_id
+
+    def increment_logins(self, player_id):
+        self.shard_for(player_id).increment_logins(player_id)
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def flush_due(self):
+        return any(shard.flush_due() for shard in self.shards)
+
+    def maybe_flush(self):
+        for shard in self.shards:
+            shard.maybe_flush()
+
+    def defer_flushes(self):
+        self.deferred = True
+        for shard in self.shards:
+            shard.defer_flushes()
+
+    def prepare_flush(self):
+        jobs = [job for job in (shard.prepare_flush() for shard in self.shards) if job is not None]
+        if not jobs:
+            return None
+
+        def flush_shards():
+            for job in jobs:
+                job()
+        return flush_shards
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
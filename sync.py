@@ -0,0 +1,133 @@
+# sync.py
+# Server-pushed player state: deltas against the last state the client acked,
+# with a full snapshot now and then so a client can always recover.
+
+from collections import OrderedDict
+
+# Pushed fields, in wire order. A delta names fields by their index here.
+STATE_FIELDS = ("sword_damage", "shield_defense", "slaying_potion_strength", "healing_potion_strength", "lives",
+                "health", "x", "y")
+
+
+def player_state(pPlayer):
+    inventory = pPlayer.inventory
+    return (pushed_stat(inventory.sword.damage), pushed_stat(inventory.shield.defense),
+            pushed_stat(inventory.slaying_potion.strength), pushed_stat(inventory.healing_potion.strength),
+            pPlayer.lives, pPlayer.health, pPlayer.x, pPlayer.y)
+
+
+def pushed_stat(value):
+    # Binary pushes carry int32s; SET_STATS only takes those, but older saved stats may not fit
+    return min(max(value, -(1 << 31)), (1 << 31) - 1)
+
+
+def apply_state(pPlayer, state):
+    # Inverse of player_state, used by the client
+    pPlayer.init_stats(*state[:4])
+    pPlayer.lives = state[4]
+    pPlayer.health = state[5]
+    pPlayer.x, pPlayer.y = state[6:8]
+
+
+class StateSync:
+    """
+    Server side of one client's push channel. update() is called once per
+    push tick with the player's current state and returns what to send, if
+    anything: (seq, base_seq, changes), where changes maps field index to
+    value and base_seq 0 means a full snapshot.
+
+    Deltas are always taken against the newest state the client acked, so a
+    lost push is repaired by the next one instead of being retransmitted.
+    """
+
+    HISTORY = 32  # Unacked states kept as possible bases
+
+    # One per active player, so slotted, and sent is a plain dict (insertion ordered too)
+    __slots__ = ("snapshot_every", "resend_every", "seq", "acked_seq", "acked_state", "sent", "last_sent",
+                 "ticks_since_send", "ticks_since_snapshot")
+
+    def __init__(self, snapshot_every=100, resend_every=5):
+        self.snapshot_every = snapshot_every  # Ticks between full snapshots
+        self.resend_every = resend_every  # Ticks to wait for an ack before pushing the same state again
+        self.seq = 0
+        self.acked_seq = 0
+        self.acked_state = None
+        self.sent = {}  # seq -> state, pushed but not acked yet, oldest first
+        self.last_sent = None
+        self.ticks_since_send = 0
+        self.ticks_since_snapshot = 0
+
+    def update(self, state):
+        self.ticks_since_send += 1
+        self.ticks_since_snapshot += 1
+        snapshot_due = self.ticks_since_snapshot >= self.snapshot_every
+        if not snapshot_due:
+            if state == self.acked_state:
+                return None  # The client is up to date
+            if state == self.last_sent and self.ticks_since_send < self.resend_every:
+                return None  # Already on its way, give the ack time to arrive
+
+        self.seq += 1
+        if snapshot_due or self.acked_state is None:
+            base_seq, changes = 0, dict(enumerate(state))
+            self.ticks_since_snapshot = 0
+        else:
+            base_seq = self.acked_seq
+            changes = {i: value for i, value in enumerate(state) if self.acked_state[i] != value}
+
+        self.sent[self.seq] = state
+        if len(self.sent) > self.HISTORY:
+            del self.sent[next(iter(self.sent))]
+        self.last_sent = state
+        self.ticks_since_send = 0
+        return self.seq, base_seq, changes
+
+    def ack(self, seq):
+        """
+        Makes the state pushed as seq the new delta base. Returns False for
+        stale or unknown acks.
+        """
+        state = self.sent.get(seq)
+        if state is None or seq <= self.acked_seq:
+            return False
+        self.acked_seq = seq
+        self.acked_state = state
+        while self.sent and next(iter(self.sent)) <= seq:
+            del self.sent[next(iter(self.sent))]  # Older states can no longer be a base
+        return True
+
+
+class StateReceiver:
+    """
+    Client side of the push channel: rebuilds full states from snapshots and
+    deltas, keeping recent ones as bases for the deltas still to come.
+    """
+
+    HISTORY = 32
+
+    def __init__(self):
+        self.states = OrderedDict()  # seq -> state
+        self.latest_seq = 0
+
+    def apply(self, seq, base_seq, changes):
+        """
+        Returns the full state pushed as seq, or None if it is stale or its
+        base is unknown (the server will send a snapshot).
+        """
+        if seq <= self.latest_seq:
+            return None
+        if base_seq == 0:
+            if len(changes) != len(STATE_FIELDS):
+                return None
+            state = tuple(changes[i] for i in range(len(STATE_FIELDS)))
+        else:
+            base = self.states.get(base_seq)
+            if base is None:
+                return None
+            state = tuple(changes.get(i, value) for i, value in enumerate(base))
+
+        self.states[seq] = state
+        if len(self.states) > self.HISTORY:
+            self.states.popitem(last=False)
+        self.latest_seq = seq
+        return state
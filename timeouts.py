@@ -0,0 +1,52 @@
+# timeouts.py
+# Expiry tracking for active clients
+
+import heapq
+
+
+class ExpiryQueue:
+    """
+    Lazy-deletion min-heap of (deadline, key).
+
+    Keys are not re-pushed every time they are touched. When an entry comes
+    due, the owner is asked for the key's current deadline: a key that has
+    been touched since is pushed back with its new deadline, a key that is
+    gone is dropped. Each key has at most one entry in the heap, so expiring
+    costs O(log n) per expired or rescheduled key and checking an idle queue
+    is a single peek.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.scheduled = set()  # Keys that currently have an entry in the heap
+
+    def add(self, key, deadline):
+        if key in self.scheduled:
+            return  # The existing entry will pick up the new deadline when it comes due
+        self.scheduled.add(key)
+        heapq.heappush(self.heap, (deadline, key))
+
+    def next_deadline(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now, deadline_of):
+        """
+        Returns the keys whose deadline has passed. deadline_of(key) returns the
+        key's current deadline, or None if it is no longer tracked.
+        """
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            _, key = heapq.heappop(heap)
+            deadline = deadline_of(key)
+            if deadline is None:
+                self.scheduled.discard(key)
+            elif deadline <= now:
+                self.scheduled.discard(key)
+                expired.append(key)
+            else:
+                heapq.heappush(heap, (deadline, key))  # Touched since, check again later
+        return expired
+
+    def __len__(self):
+        return len(self.heap)